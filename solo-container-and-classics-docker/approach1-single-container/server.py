@@ -2,36 +2,2562 @@
 """
 Simple HTTP server that responds with system information
 """
-import http.server
+import argparse
+import asyncio
+import collections
+import contextlib
+import gc
+import hashlib
+import heapq
+import http
+import signal
+import socket
 import socketserver
+import stat
+import struct
 import json
+import math
+import mmap
 import os
+import select
+import selectors
+import sys
+import threading
 import time
+import traceback
+import types
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from urllib.parse import parse_qs
 
 PORT = 8080
 
-class InfoHandler(http.server.BaseHTTPRequestHandler):
-    def do_GET(self):
-        response = {
-            "timestamp": datetime.now().isoformat(),
-            "hostname": os.uname().nodename,
-            "pid": os.getpid(),
-            "message": "Hello from the server!",
-            "uptime": time.time()
-        }
-
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(response, indent=2).encode())
-
-    def log_message(self, format, *args):
-        # Custom logging
-        print(f"[{datetime.now().isoformat()}] {format % args}")
+# Monotonic start time; forked workers inherit it, so uptime is the
+# server's rather than the worker's
+STARTED = time.monotonic()
+
+# Concurrency engines selectable with --engine
+ENGINES = ("serial", "threads", "asyncio", "selectors")
+DEFAULT_ENGINE = "threads"
+DEFAULT_WORKERS = 64
+DEFAULT_BACKLOG = 128
+
+# A pre-forked worker that dies sooner than this after being started is
+# restarted with a delay, so a crash on startup doesn't turn into a fork loop
+RESPAWN_DELAY = 1.0
+# Signals the pre-fork parent forwards to its workers on shutdown
+SHUTDOWN_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+# Seconds a connection may sit idle between requests before it is dropped,
+# so a stalled or forgotten client cannot hold on to a worker forever
+KEEPALIVE_TIMEOUT = 15
+# Requests served on one persistent connection before the server closes it
+MAX_KEEPALIVE_REQUESTS = 1000
+# Seconds the serial engine waits for a kept-alive connection's next
+# request before handing over to a queued connection; covers a client
+# that sends it right after reading the previous response
+KEEPALIVE_GRACE = 0.05
+# Limits on a request head (request line plus headers); a request beyond
+# either is answered with 431 and the connection closed
+MAX_HEAD_BYTES = 16384
+MAX_HEADERS = 100
+# Request bodies are read and thrown away, since nothing here takes one;
+# a Content-Length beyond this is answered with 413 and the connection
+# closed. Transfer-Encoding (chunked bodies) gets a 501 the same way.
+MAX_BODY_BYTES = 65536
+
+# selectors engine: bytes read per recv() call, and the granularity in
+# seconds of the timer wheel that reaps idle connections
+RECV_SIZE = 16384
+WHEEL_TICK = 1.0
+
+SERVER_SOFTWARE = f"BaseHTTP/0.6 Python/{sys.version.split()[0]}"
+
+# Seconds the formatted wall-clock strings are reused for; 0 formats on
+# every read
+DEFAULT_CLOCK_TICK = 0.001
+
+# Access log batching: lines are queued by request handlers and written by
+# a background thread once LOG_BATCH_SIZE are waiting or every
+# LOG_FLUSH_INTERVAL seconds. Lines beyond LOG_QUEUE_SIZE are dropped and
+# counted rather than slowing requests down.
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.2
+LOG_QUEUE_SIZE = 10000
+
+# Latency histogram layout: every power-of-two octave of microseconds is
+# split into 2**HISTOGRAM_SUB_BITS linear buckets, up to 2**HISTOGRAM_OCTAVES
+# microseconds (about 67s); slower requests land in the last bucket
+HISTOGRAM_SUB_BITS = 2
+HISTOGRAM_OCTAVES = 26
+# Distinct path label values on /metrics; further paths count as "other"
+MAX_PATH_LABELS = 32
+METRICS_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+# Seconds between host/process statistics samples read from /proc
+SAMPLE_INTERVAL = 1.0
+# Samples kept for /batch history windows
+HISTORY_LENGTH = 300
+
+# Seconds between snapshots pushed to /stream subscribers
+STREAM_INTERVAL = 1.0
+# Bytes an asyncio /stream subscriber may have waiting in its send buffer
+# before it is considered stuck and disconnected
+STREAM_BUFFER_LIMIT = 256 * 1024
+# Share of --max-workers that /stream subscribers may hold in the threads
+# engine, where each one keeps a worker; the rest are refused with a 503
+STREAM_WORKER_SHARE = 0.25
+
+# Shared-memory snapshot file (--shm): SHM_HEADER, then the compact info
+# body at SHM_DATA_OFFSET. The header holds the magic, a sequence number
+# that is odd while a write is in progress, the body length, and the
+# wall-clock time and interval of the publisher. client.py has a copy.
+SHM_MAGIC = b"INFOSHM1"
+SHM_HEADER = struct.Struct("<8sQIdd")
+SHM_DATA_OFFSET = 64
+SHM_SIZE = 64 * 1024
+# Seconds between snapshots written to the --shm file
+SHM_INTERVAL = 1.0
+
+# Seconds between polls the server paces pollers to (X-Poll-After); 0
+# turns pacing off
+POLL_INTERVAL = 5.0
+# Longest interval a poller may ask for with X-Poll-Interval, as a
+# multiple of the server's
+MAX_POLL_INTERVAL_FACTOR = 10
+# Pollers the pacer keeps track of; the least recently seen is forgotten
+# first and stops counting
+MAX_POLLERS = 10000
+
+# Clients whose rate limit buckets are remembered; the least recently seen
+# is forgotten first and starts over with a full bucket
+MAX_RATE_CLIENTS = 10000
+
+# Body encodings, selectable per request with ?format=
+FORMATS = {
+    "indent": {"indent": 2},
+    "compact": {"separators": (",", ":")},
+}
+DEFAULT_FORMAT = "indent"
+
+# Response fields that change on every request. Everything else is
+# rendered once into an InfoTemplate.
+DYNAMIC_FIELDS = ("timestamp", "uptime")
+# Distinct ?fields= subsets whose templates are kept per process
+MAX_PROJECTIONS = 256
+# Sub-queries one /batch request may carry
+MAX_BATCH = 32
+# Snapshot versions kept as bases for merge-patch deltas; at one sample a
+# second a poller may be a minute behind and still get a delta
+DELTA_VERSIONS = 64
+# Fields covered by the info ETag. A 304 tells a poller these are
+# unchanged; the timestamp and statistics in its cached copy go stale.
+STABLE_FIELDS = ("hostname", "pid", "message")
+
+
+class CoarseClock:
+    """Wall-clock strings formatted at most once per tick.
+
+    The response body, the Date header and the access log all read from
+    the one clock, so under load a timestamp costs a time.time() call
+    instead of a datetime format. Each cache is a single tuple that is
+    swapped whole, which keeps readers on other threads consistent
+    without a lock.
+    """
+
+    def __init__(self, tick=DEFAULT_CLOCK_TICK):
+        self.tick = tick
+        self._iso = (0.0, "")
+        self._http_date = (0, "")
+
+    def isoformat(self):
+        now = time.time()
+        expires, text = self._iso
+        if now >= expires:
+            text = datetime.fromtimestamp(now).isoformat()
+            self._iso = (now + self.tick, text)
+        return text
+
+    def http_date(self):
+        """RFC 7231 date for the Date header; changes once a second"""
+        now = int(time.time())
+        second, text = self._http_date
+        if now != second:
+            t = time.gmtime(now)
+            text = (f"{WEEKDAYS[t.tm_wday]}, {t.tm_mday:02d} "
+                    f"{MONTHS[t.tm_mon - 1]} {t.tm_year} "
+                    f"{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d} GMT")
+            self._http_date = (now, text)
+        return text
+
+
+# Fixed English names for HTTP dates, whatever the locale
+WEEKDAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun",
+          "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+CLOCK = CoarseClock()
+
+
+def read_proc(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class SystemSampler:
+    """Host and process statistics read from /proc on a background thread.
+
+    Each sample is published as a new read-only mapping that replaces the
+    previous one in a single attribute assignment, so request handlers
+    read self.snapshot without taking a lock. After every sample the info
+    templates are rebuilt, which keeps these fields out of the per-request
+    work entirely. Statistics that can't be read (no /proc) are None.
+
+    The last history_length samples are kept in self.history as
+    (monotonic time, compact JSON) pairs, encoded once when taken. The
+    tuple is replaced the same way as the snapshot.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL, history_length=HISTORY_LENGTH):
+        self.interval = interval
+        self.history_length = history_length
+        self.snapshot = types.MappingProxyType({})
+        self.history = ()
+        self._cpu = None
+        self._process_cpu = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="sampler",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+
+    def sample(self):
+        """Take a sample now and publish it"""
+        self.snapshot = types.MappingProxyType({
+            "system": {
+                "load_average": self.load_average(),
+                "cpu_percent": self.cpu_percent(),
+                **self.memory(),
+            },
+            "process": {
+                "cpu_percent": self.process_cpu_percent(),
+                "rss_bytes": self.rss_bytes(),
+                "open_fds": self.open_fds(),
+            },
+        })
+        encoded = json.dumps({"timestamp": datetime.now().isoformat(),
+                              **self.snapshot},
+                             **FORMATS["compact"]).encode()
+        dropped = max(0, len(self.history) + 1 - self.history_length)
+        self.history = (*self.history[dropped:], (time.monotonic(), encoded))
+
+    def load_average(self):
+        try:
+            return [round(load, 2) for load in os.getloadavg()]
+        except OSError:
+            return None
+
+    def cpu_percent(self):
+        """Host CPU busy share since the previous sample"""
+        stat = read_proc("/proc/stat")
+        if stat is None:
+            return None
+        ticks = [int(n) for n in stat.split("\n", 1)[0].split()[1:]]
+        idle = ticks[3] + (ticks[4] if len(ticks) > 4 else 0)
+        total = sum(ticks)
+        previous, self._cpu = self._cpu, (idle, total)
+        if previous is None or total == previous[1]:
+            return None
+        busy = 1 - (idle - previous[0]) / (total - previous[1])
+        return round(busy * 100, 1)
+
+    def memory(self):
+        meminfo = read_proc("/proc/meminfo")
+        fields = {}
+        for line in (meminfo or "").splitlines():
+            name, _, value = line.partition(":")
+            if name in ("MemTotal", "MemAvailable"):
+                fields[name] = int(value.split()[0]) * 1024
+        return {"memory_total_bytes": fields.get("MemTotal"),
+                "memory_available_bytes": fields.get("MemAvailable")}
+
+    def process_cpu_percent(self):
+        """This process's CPU time as a share of one core since last sample"""
+        times = os.times()
+        now = (times.user + times.system, time.monotonic())
+        previous, self._process_cpu = self._process_cpu, now
+        if previous is None or now[1] == previous[1]:
+            return None
+        return round((now[0] - previous[0]) / (now[1] - previous[1]) * 100, 1)
+
+    def rss_bytes(self):
+        statm = read_proc("/proc/self/statm")
+        if statm is None:
+            return None
+        return int(statm.split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def open_fds(self):
+        try:
+            return len(os.listdir("/proc/self/fd"))
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+            load_templates()
+
+
+SYSTEM = SystemSampler()
+
+
+def build_info():
+    """Collect the information returned to clients"""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "hostname": os.uname().nodename,
+        "pid": os.getpid(),
+        "message": "Hello from the server!",
+        "uptime": time.monotonic() - STARTED,
+        **SYSTEM.snapshot,
+    }
+
+
+def encode_value(value):
+    """JSON-encode a scalar field value"""
+    if isinstance(value, str):
+        return encode_basestring_ascii(value).encode()
+    return repr(value).encode()
+
+
+class InfoTemplate:
+    """The info body pre-rendered once, with holes for the dynamic fields.
+
+    The static fields are serialized at startup and split around the
+    dynamic ones, so answering a request only encodes those few values and
+    joins them with the stored byte segments. Dynamic fields missing from
+    info get no hole and are never computed.
+    """
+
+    def __init__(self, info, **dumps_options):
+        holes = {name: f"<{name}>" for name in DYNAMIC_FIELDS if name in info}
+        text = json.dumps({**info, **holes}, **dumps_options)
+        markers = {name: json.dumps(hole) for name, hole in holes.items()}
+
+        self.segments = []
+        self.fields = sorted(holes,
+                             key=lambda name: text.index(markers[name]))
+        for name in self.fields:
+            head, text = text.split(markers[name], 1)
+            self.segments.append(head.encode())
+        self.segments.append(text.encode())
+
+    def render(self):
+        parts = [self.segments[0]]
+        for name, segment in zip(self.fields, self.segments[1:]):
+            parts.append(encode_value(DYNAMIC_VALUES[name]()))
+            parts.append(segment)
+        return b"".join(parts)
+
+
+# How each dynamic field is computed when a template is rendered
+DYNAMIC_VALUES = {
+    "timestamp": lambda: CLOCK.isoformat(),
+    "uptime": lambda: time.monotonic() - STARTED,
+}
+
+
+# Per-process templates; built by load_templates() since pid and hostname
+# must be read again after a fork, and rebuilt after every system sample.
+# The dict is replaced, never updated, so readers always see a whole set.
+TEMPLATES = {}
+# Weak validator per format over STABLE_FIELDS, set with the templates
+ETAGS = {}
+# (info, {(fields, format): InfoTemplate}) for ?fields= subsets. Templates
+# are built on first use from the info the full ones came from, and the
+# pair is replaced as one so a new template is never built from old info.
+PROJECTIONS = ({}, {})
+
+
+def has_null_member(value):
+    """Whether value is an object with a null somewhere in its members"""
+    return isinstance(value, dict) and any(
+        member is None or has_null_member(member)
+        for member in value.values())
+
+
+def merge_patch(old, new):
+    """JSON merge patch (RFC 7396) turning old into new.
+
+    Returns None when there is no such patch: a merge patch can't set a
+    value to null, since null means remove, and that holds for the members
+    of an object it sets as well.
+    """
+    patch = {name: None for name in old if name not in new}
+    for name, value in new.items():
+        if name in old and old[name] == value:
+            continue
+        if value is None:
+            return None
+        if isinstance(value, dict) and isinstance(old.get(name), dict):
+            value = merge_patch(old[name], value)
+            if value is None:
+                return None
+        elif has_null_member(value):
+            return None
+        patch[name] = value
+    return patch
+
+
+class SnapshotVersions:
+    """Recent info snapshots by version, for delta responses.
+
+    load_templates() hands every new info object to update(); a new
+    version is only taken when something besides the dynamic fields
+    changed. Versions are "<epoch>-<n>" with n increasing and the epoch
+    drawn per process, so a version from another worker or an earlier run
+    is never mistaken for one of ours. A poller that sends the version it
+    holds gets a merge patch up to the current one plus the dynamic
+    fields, or the full body when that version is gone.
+
+    All state is one (version, {version: info}, {(base, format): (template,
+    is_patch)}) tuple replaced as a whole, so a body is always rendered from
+    the same snapshot its version names.
+    """
+
+    def __init__(self, keep=DELTA_VERSIONS):
+        self.keep = keep
+        self.pid = None
+        self.epoch = None
+        self.count = 0
+        self.state = (None, {}, {})
+
+    def update(self, info, templates):
+        """Take info as a new version unless only dynamic fields changed.
+
+        templates are the full-body InfoTemplates already built from it,
+        by format.
+        """
+        version, infos, _ = self.state
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.epoch = os.urandom(4).hex()
+            version, infos = None, {}
+        elif version is not None and \
+                self.static(infos[version]) == self.static(info):
+            return
+        self.count += 1
+        version = f"{self.epoch}-{self.count}"
+        dropped = max(0, len(infos) + 1 - self.keep)
+        infos = dict(list(infos.items())[dropped:])
+        infos[version] = info
+        self.state = (version, infos,
+                      {(None, format): (template, False)
+                       for format, template in templates.items()})
+
+    @staticmethod
+    def static(info):
+        return {name: value for name, value in info.items()
+                if name not in DYNAMIC_FIELDS}
+
+    def lookup(self, base, format):
+        """(version, template, is_patch) for a poller holding base"""
+        version, infos, templates = self.state
+        if base not in infos:
+            base = None
+        key = base, format
+        cached = templates.get(key)
+        if cached is None:
+            info = infos[version]
+            patch = None
+            if base is not None:
+                patch = merge_patch(self.static(infos[base]),
+                                    self.static(info))
+            if patch is None:
+                cached = InfoTemplate(info, **FORMATS[format]), False
+            else:
+                dynamic = {name: info[name] for name in DYNAMIC_FIELDS
+                           if name in info}
+                cached = (InfoTemplate({**patch, **dynamic},
+                                       **FORMATS[format]), True)
+            templates[key] = cached
+        return (version, *cached)
+
+
+VERSIONS = SnapshotVersions()
+
+
+def load_templates():
+    global TEMPLATES, ETAGS, PROJECTIONS
+    info = build_info()
+    TEMPLATES = {name: InfoTemplate(info, **options)
+                 for name, options in FORMATS.items()}
+    VERSIONS.update(info, TEMPLATES)
+    stable = json.dumps([info[name] for name in STABLE_FIELDS]).encode()
+    digest = hashlib.blake2b(stable, digest_size=8).hexdigest()
+    ETAGS = {name: f'W/"{digest}-{name}"' for name in FORMATS}
+    PROJECTIONS = (info, {})
+
+
+def parse_fields(values):
+    """Turn ?fields= values into a field tuple in response order.
+
+    Raises ValueError naming the fields the info doesn't have.
+    """
+    info = PROJECTIONS[0]
+    requested = {name.strip() for value in values
+                 for name in value.split(",") if name.strip()}
+    unknown = requested.difference(info)
+    if unknown:
+        raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}, "
+                         f"expected some of: {', '.join(info)}")
+    return tuple(name for name in info if name in requested)
+
+
+def projection(fields, format):
+    """The template rendering only fields, built once per field set"""
+    info, templates = PROJECTIONS
+    key = fields, format
+    template = templates.get(key)
+    if template is None:
+        template = InfoTemplate({name: info[name] for name in fields},
+                                **FORMATS[format])
+        if len(templates) < MAX_PROJECTIONS:
+            templates[key] = template
+    return template
+
+
+def projection_etag(fields, etag):
+    """The validator for a ?fields= projection of the body tagged etag.
+
+    The field set is part of the tag, so a projection never validates the
+    full body or another projection. A projection of only dynamic fields
+    gets None: there is nothing in it a 304 could vouch for.
+    """
+    if set(fields).issubset(DYNAMIC_FIELDS):
+        return None
+    digest = hashlib.blake2b(",".join(fields).encode(),
+                             digest_size=4).hexdigest()
+    return f'{etag[:-1]}-{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against etag"""
+    if if_none_match.strip() == "*":
+        return True
+    bare = etag[2:]
+    return any(tag.strip().removeprefix("W/") == bare
+               for tag in if_none_match.split(","))
+
+
+def has_body(status):
+    return status not in (204, 304) and status >= 200
+
+
+def render_info(format=DEFAULT_FORMAT, fields=None):
+    """Serialize the info response body, or only fields of it"""
+    if not TEMPLATES:
+        load_templates()
+    if fields is not None:
+        return projection(fields, format).render()
+    return TEMPLATES[format].render()
+
+
+def render_history(seconds):
+    """Compact JSON array of the samples taken in the last seconds"""
+    since = time.monotonic() - seconds
+    return b"[%s]" % b",".join(encoded for taken, encoded in SYSTEM.history
+                               if taken >= since)
+
+
+def render_batch(subqueries):
+    """Answer every sub-query in one compact JSON array, in request order.
+
+    A sub-query is "info" for the whole info object, "fields=a,b" for a
+    projection of it or "history=SECONDS" for recent samples. Each result
+    is rendered once to bytes and the array is joined in a single pass.
+    Raises ValueError describing the first sub-query that can't be run.
+    """
+    if not subqueries:
+        raise ValueError("Expected at least one q= sub-query")
+    if len(subqueries) > MAX_BATCH:
+        raise ValueError(f"At most {MAX_BATCH} sub-queries per batch")
+    parts = []
+    for subquery in subqueries:
+        name, _, value = subquery.partition("=")
+        if name == "info" and not value:
+            parts.append(render_info("compact"))
+        elif name == "fields":
+            parts.append(render_info("compact", parse_fields([value])))
+        elif name == "history":
+            try:
+                seconds = float(value)
+            except ValueError:
+                raise ValueError(f"Bad history window {value!r}, expected "
+                                 f"seconds") from None
+            parts.append(render_history(seconds))
+        else:
+            raise ValueError(f"Unknown sub-query {subquery!r}, expected "
+                             f"info, fields=... or history=SECONDS")
+    return b"[%s]" % b",".join(parts)
+
+
+def handle_get(path, headers, client=""):
+    """Answer a GET for path from the client address.
+
+    headers is looked up with lower-case names. Returns (status, response
+    headers as (name, value) pairs, body).
+    """
+    if path.partition("?")[0] == "/metrics":
+        return (200, [("Content-type", "text/plain; version=0.0.4")],
+                METRICS.render().encode())
+    if path.partition("?")[0] == "/healthz":
+        return 200, [("Content-type", "text/plain")], b"ok\n"
+    if path.partition("?")[0] == "/batch":
+        query = parse_qs(path.partition("?")[2], keep_blank_values=True)
+        try:
+            body = render_batch(query.get("q", []))
+        except ValueError as e:
+            return 400, [("Content-type", "text/plain")], str(e).encode()
+        return 200, [("Content-type", "application/json")], body
+
+    format = DEFAULT_FORMAT
+    fields = None
+    if "?" in path:
+        query = parse_qs(path.partition("?")[2])
+        format = query.get("format", [format])[-1]
+        if format not in FORMATS:
+            return (400, [("Content-type", "text/plain")],
+                    f"Unknown format {format!r}, expected one of: "
+                    f"{', '.join(FORMATS)}".encode())
+        if "fields" in query:
+            try:
+                fields = parse_fields(query["fields"])
+            except ValueError as e:
+                return 400, [("Content-type", "text/plain")], str(e).encode()
+
+    etag = ETAGS[format]
+    if fields is not None:
+        etag = projection_etag(fields, etag)
+    response_headers = [("ETag", etag)] if etag else []
+    poller = headers.get("x-poller-id")
+    if poller and PACER.interval:
+        delay = PACER.next_delay(
+            (client, poller), parse_interval(headers.get("x-poll-interval")))
+        response_headers.append(("X-Poll-After", f"{delay:.3f}"))
+    # Pollers sending X-Snapshot-Since get a delta or a full body, never a
+    # 304, so the version they hold always matches their data
+    base = None
+    if fields is None:
+        base = headers.get("x-snapshot-since")
+        version, template, is_patch = VERSIONS.lookup(base, format)
+        response_headers.append(("X-Snapshot-Version", version))
+    if_none_match = headers.get("if-none-match")
+    if base is None and etag and if_none_match and \
+            etag_matches(if_none_match, etag):
+        return 304, response_headers, b""
+    if fields is not None:
+        response_headers.append(("Content-type", "application/json"))
+        return 200, response_headers, render_info(format, fields)
+    response_headers.append(("Content-type", "application/merge-patch+json"
+                             if is_patch else "application/json"))
+    return 200, response_headers, template.render()
+
+
+class AccessLog:
+    """Access log written in batches by a background thread.
+
+    Request handlers only append a tuple to a deque; formatting and the
+    write to stdout (a pipe under supervisord, the journal under systemd)
+    happen on the writer thread, so a stalled log consumer never stalls a
+    request. With sample=N only every Nth successful request is logged;
+    errors (status >= 400, or no status at all) are always logged.
+    """
+
+    def __init__(self, stream=None, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, max_queue=LOG_QUEUE_SIZE,
+                 sample=1):
+        self.stream = stream
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.sample = sample
+        self.written = 0
+        self.dropped = 0
+        self._reported_drops = 0
+        self._seen = 0
+        self._pending = collections.deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def start(self):
+        """Start the writer thread; needed again in every forked worker"""
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="access-log",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def log(self, status, format, *args):
+        if self.sample > 1 and status is not None and status < 400:
+            self._seen += 1
+            if self._seen % self.sample:
+                return
+        if len(self._pending) >= self.max_queue:
+            self.dropped += 1
+            return
+        self._pending.append((CLOCK.isoformat(), format, args))
+        if len(self._pending) == self.batch_size:
+            self._wake.set()
+
+    def flush(self):
+        # Only one flush may run at a time so batches keep their order
+        with self._lock:
+            lines = []
+            try:
+                while True:
+                    timestamp, format, args = self._pending.popleft()
+                    lines.append(f"[{timestamp}] {format % args}\n")
+            except IndexError:
+                pass
+            dropped = self.dropped - self._reported_drops
+            if dropped:
+                self._reported_drops += dropped
+                lines.append(f"[{CLOCK.isoformat()}] access log queue full, "
+                             f"dropped {dropped} lines "
+                             f"({self._reported_drops} total)\n")
+            if not lines:
+                return
+            stream = self.stream or sys.stdout
+            try:
+                stream.write("".join(lines))
+                stream.flush()
+            except (OSError, ValueError):
+                return
+            self.written += len(lines)
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+ACCESS_LOG = AccessLog()
+
+
+def histogram_index(micros):
+    """Bucket for a latency in whole microseconds"""
+    sub_buckets = 1 << HISTOGRAM_SUB_BITS
+    if micros < sub_buckets:
+        return micros
+    octave = micros.bit_length() - HISTOGRAM_SUB_BITS
+    sub = (micros >> (octave - 1)) & (sub_buckets - 1)
+    return min(octave * sub_buckets + sub, len(HISTOGRAM_BOUNDS) - 1)
+
+
+def histogram_bounds():
+    """Exclusive upper bound of every bucket, in seconds"""
+    sub_buckets = 1 << HISTOGRAM_SUB_BITS
+    bounds = [float(i + 1) for i in range(sub_buckets)]
+    for octave in range(1, HISTOGRAM_OCTAVES - HISTOGRAM_SUB_BITS + 1):
+        for sub in range(sub_buckets):
+            bounds.append(float((sub_buckets + sub + 1) << (octave - 1)))
+    return [bound / 1e6 for bound in bounds]
+
+
+HISTOGRAM_BOUNDS = histogram_bounds()
+
+
+class MetricsShard:
+    """Counters owned by a single thread, so updates need no lock"""
+
+    def __init__(self):
+        self.requests = {}
+        self.started = 0
+        self.finished = 0
+        self.bytes_sent = 0
+        self.latency_sum = 0.0
+        self.latency = [0] * len(HISTOGRAM_BOUNDS)
+
+
+class Metrics:
+    """Request metrics exposed on /metrics in Prometheus text format.
+
+    Each thread records into its own MetricsShard: a counter bump and a
+    list slot increment, no locks and no allocation once a path/status pair
+    has been seen. A scrape sums the shards without stopping the threads
+    that are writing to them, so it may be a request or two behind but it
+    never blocks request handling. With --workers each process keeps its
+    own metrics.
+    """
+
+    def __init__(self):
+        self.shards = []
+        self.paths = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = MetricsShard()
+            with self._lock:
+                self.shards.append(shard)
+            return shard
+
+    def start(self):
+        """Mark a request in flight; returns the start time to finish()"""
+        self.shard().started += 1
+        return time.perf_counter()
+
+    def finish(self, started, path, status, size):
+        elapsed = time.perf_counter() - started
+        path = path.partition("?")[0]
+        if path not in self.paths:
+            with self._lock:
+                if len(self.paths) < MAX_PATH_LABELS:
+                    self.paths.add(path)
+                else:
+                    path = "other"
+
+        shard = self.shard()
+        key = (path, status)
+        shard.requests[key] = shard.requests.get(key, 0) + 1
+        shard.finished += 1
+        shard.bytes_sent += size
+        shard.latency_sum += elapsed
+        shard.latency[histogram_index(int(elapsed * 1e6))] += 1
+
+    def render(self):
+        requests = collections.Counter()
+        latency = [0] * len(HISTOGRAM_BOUNDS)
+        in_flight = bytes_sent = 0
+        latency_sum = 0.0
+        for shard in list(self.shards):
+            requests.update(dict(shard.requests))
+            in_flight += shard.started - shard.finished
+            bytes_sent += shard.bytes_sent
+            latency_sum += shard.latency_sum
+            for i, count in enumerate(shard.latency):
+                latency[i] += count
+
+        lines = [
+            "# HELP info_requests_total Requests answered, by path and status.",
+            "# TYPE info_requests_total counter",
+        ]
+        for (path, status), count in sorted(requests.items()):
+            lines.append(f'info_requests_total{{path="{escape_label(path)}",'
+                         f'status="{status}"}} {count}')
+        lines += [
+            "# HELP info_requests_in_flight Requests currently being answered.",
+            "# TYPE info_requests_in_flight gauge",
+            f"info_requests_in_flight {in_flight}",
+            "# HELP info_response_bytes_total Response body bytes sent.",
+            "# TYPE info_response_bytes_total counter",
+            f"info_response_bytes_total {bytes_sent}",
+            "# HELP info_request_duration_seconds Time to answer a request.",
+            "# TYPE info_request_duration_seconds histogram",
+        ]
+        total = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, latency):
+            total += count
+            lines.append(f'info_request_duration_seconds_bucket'
+                         f'{{le="{bound:g}"}} {total}')
+        lines += [
+            f'info_request_duration_seconds_bucket{{le="+Inf"}} {total}',
+            f"info_request_duration_seconds_sum {latency_sum}",
+            f"info_request_duration_seconds_count {total}",
+            "# HELP info_request_duration_quantile_seconds Latency quantiles "
+            "estimated from the histogram buckets.",
+            "# TYPE info_request_duration_quantile_seconds gauge",
+        ]
+        for q in METRICS_QUANTILES:
+            lines.append(f'info_request_duration_quantile_seconds'
+                         f'{{quantile="{q}"}} {histogram_quantile(latency, q)}')
+        lines += [
+            "# HELP info_access_log_dropped_total Access log lines dropped "
+            "because the queue was full.",
+            "# TYPE info_access_log_dropped_total counter",
+            f"info_access_log_dropped_total {ACCESS_LOG.dropped}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def histogram_quantile(counts, q):
+    """Upper bound of the bucket holding quantile q, or 0 with no samples"""
+    total = sum(counts)
+    if not total:
+        return 0.0
+    rank = max(1, int(q * total + 0.5))
+    seen = 0
+    for bound, count in zip(HISTOGRAM_BOUNDS, counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return HISTOGRAM_BOUNDS[-1]
+
+
+def escape_label(value):
+    return (value.replace("\\", "\\\\").replace('"', '\\"')
+            .replace("\n", "\\n"))
+
+
+METRICS = Metrics()
+
+
+class SnapshotStream:
+    """Info snapshots serialized once per tick and fanned out over SSE.
+
+    A ticker thread renders the compact body once per interval, wraps it in
+    a server-sent event and hands the same bytes to every subscriber:
+    threads-engine handlers wait on a condition, event loops register a
+    callback that writes the frame to all of their connections. Nothing is
+    rendered while there are no subscribers.
+    """
+
+    def __init__(self, interval=STREAM_INTERVAL):
+        self.interval = interval
+        self.seq = 0
+        self.frame = b""
+        self.subscribers = 0
+        self._listeners = []
+        self._changed = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="stream",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        with self._changed:
+            self._changed.notify_all()
+
+    def add_listener(self, callback):
+        """Call callback(frame) from the ticker thread on every snapshot"""
+        self._listeners.append(callback)
+
+    def subscribe(self, limit=None):
+        """Count a new subscriber; False when limit are already counted"""
+        with self._changed:
+            if limit is not None and self.subscribers >= limit:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._changed:
+            self.subscribers -= 1
+
+    def wait(self, seq):
+        """Block until a snapshot newer than seq; returns (seq, frame).
+
+        The frame is None once the stream has been closed.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.seq != seq or self._stopped.is_set())
+            if self._stopped.is_set():
+                return seq, None
+            return self.seq, self.frame
+
+    def publish(self):
+        body = render_info("compact")
+        with self._changed:
+            self.seq += 1
+            self.frame = b"id: %d\ndata: %s\n\n" % (self.seq, body)
+            self._changed.notify_all()
+        for callback in self._listeners:
+            callback(self.frame)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self.subscribers:
+                self.publish()
+
+
+STREAM = SnapshotStream()
+
+
+class SharedSnapshot:
+    """Info snapshots published into a memory-mapped file for local readers.
+
+    A writer thread renders the compact body once per interval and copies
+    it into the mapping under a seqlock: the sequence number is made odd,
+    the body and header are written, then it is made even again. A reader
+    on the same host maps the file once and copies a snapshot out without
+    any syscall, retrying while the sequence is odd or changed under it.
+    There must be a single writer per file. The file is reused across
+    restarts, so mapped readers keep working, and on close the body length
+    is set to 0 to tell them nothing is being published.
+    """
+
+    def __init__(self, interval=SHM_INTERVAL):
+        self.interval = interval
+        self.seq = 0
+        self.skipped = 0
+        self._map = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def open(self, path):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != SHM_SIZE:
+                os.ftruncate(fd, SHM_SIZE)
+            self._map = mmap.mmap(fd, SHM_SIZE)
+        finally:
+            os.close(fd)
+        magic, seq = SHM_HEADER.unpack_from(self._map)[:2]
+        # Carry on from the previous writer's sequence so it never repeats
+        self.seq = seq + (seq & 1) if magic == SHM_MAGIC else 0
+        self._map[:len(SHM_MAGIC)] = SHM_MAGIC
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="shm",
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._map is None:
+            return
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write(b"")
+        self._map.close()
+        self._map = None
+
+    def write(self, body):
+        if len(body) > SHM_SIZE - SHM_DATA_OFFSET:
+            self.skipped += 1
+            if self.skipped == 1:
+                ACCESS_LOG.log(None, "snapshot of %d bytes doesn't fit the "
+                               "shared memory file", len(body))
+            return
+        struct.pack_into("<Q", self._map, 8, self.seq + 1)
+        self._map[SHM_DATA_OFFSET:SHM_DATA_OFFSET + len(body)] = body
+        SHM_HEADER.pack_into(self._map, 0, SHM_MAGIC, self.seq + 1,
+                             len(body), time.time(), self.interval)
+        self.seq += 2
+        struct.pack_into("<Q", self._map, 8, self.seq)
+
+    def publish(self):
+        self.write(render_info("compact"))
+
+    def _run(self):
+        self.publish()
+        while not self._stopped.wait(self.interval):
+            self.publish()
+
+
+SHARED_SNAPSHOT = SharedSnapshot()
+
+
+def take_token(bucket, rate, burst, now):
+    """Refill a [tokens, updated] bucket and take one token from it.
+
+    Returns 0 if a token was taken, otherwise the seconds until one will be
+    available.
+    """
+    tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return 0
+    bucket[0] = tokens
+    return (1 - tokens) / rate
+
+
+def shed(status, retry_after, message):
+    return (status, [("Content-type", "text/plain"),
+                     ("Retry-After", str(max(1, math.ceil(retry_after))))],
+            message.encode())
+
+
+class Admission:
+    """Load shedding in front of the request handlers.
+
+    A request is turned away at once when max_in_flight requests are
+    already being answered (503), when the server-wide token bucket is
+    empty (503) or when its client's bucket is empty (429), each with a
+    Retry-After telling the client when to come back. Buckets hold up to
+    burst tokens (default: one second's worth) and refill at rate per
+    second. A rate or max_in_flight of 0 turns that limit off. With
+    healthz_priority, /healthz skips every check so health probes keep
+    answering under overload. /stream subscriptions are rate limited but
+    don't count as in flight, since they last as long as the client stays.
+    """
+
+    def __init__(self, max_in_flight=0, rate=0, burst=None, client_rate=0,
+                 client_burst=None, healthz_priority=False):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = burst
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.healthz_priority = healthz_priority
+        self.in_flight = 0
+        self._bucket = None
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def prioritized(self, path):
+        return self.healthz_priority and path == "/healthz"
+
+    @contextlib.contextmanager
+    def request(self, client, path):
+        """Admit one request for the duration of the with block.
+
+        Yields None if the request is to be served, or the (status,
+        headers, body) response to send instead.
+        """
+        if self.prioritized(path):
+            yield None
+            return
+        with self._lock:
+            rejection = self._check(client)
+            held = rejection is None and path != "/stream"
+            if held:
+                self.in_flight += 1
+        try:
+            yield rejection
+        finally:
+            if held:
+                with self._lock:
+                    self.in_flight -= 1
+
+    def _check(self, client):
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            return shed(503, 1, "Too many requests in flight")
+        now = time.monotonic()
+        bucket = None
+        if self.client_rate:
+            burst = self.client_burst or max(1, self.client_rate)
+            # Re-inserting keeps the dict in least recently seen order
+            bucket = self._clients.pop(client, None) or [burst, now]
+            self._clients[client] = bucket
+            if len(self._clients) > MAX_RATE_CLIENTS:
+                del self._clients[next(iter(self._clients))]
+            wait = take_token(bucket, self.client_rate, burst, now)
+            if wait:
+                return shed(429, wait, "Client rate limit exceeded")
+        if self.rate:
+            burst = self.burst or max(1, self.rate)
+            if self._bucket is None:
+                self._bucket = [burst, now]
+            wait = take_token(self._bucket, self.rate, burst, now)
+            if wait:
+                if bucket is not None:
+                    # Not served, so give the client its token back
+                    bucket[0] += 1
+                return shed(503, wait, "Server rate limit exceeded")
+        return None
+
+
+ADMISSION = Admission()
+
+
+class Pacer:
+    """Tells each poller when to come back so polls spread out evenly.
+
+    Pollers identify themselves with an X-Poller-Id header, and may send
+    the interval they were configured with in X-Poll-Interval; the others
+    are paced to the server's interval. A phase cursor advances by
+    1 / pollers for every poll, so one full round of polls moves it once
+    around, and each poller is told to come back at the cursor's phase of
+    its interval, between half and one and a half intervals from now. A
+    herd arriving at once is handed consecutive slots, spreads out over
+    the next rounds and then keeps its place. The interval stretches with
+    the host's load average per CPU and, under --rate-limit, with the
+    number of pollers so their polls fit within that rate. A poller not
+    heard from for two of its intervals stops counting, and so does the
+    least recently seen one beyond MAX_POLLERS. Requested intervals are
+    capped at MAX_POLL_INTERVAL_FACTOR times the server's.
+    """
+
+    def __init__(self, interval=POLL_INTERVAL):
+        self.interval = interval
+        self._phase = 0.0
+        # Poller -> monotonic time it stops counting, least recent first
+        self._pollers = {}
+        # (time, poller) for every time handed out, soonest first; entries
+        # the poller has since moved on from are skipped
+        self._expiry = []
+        self._cpus = os.cpu_count() or 1
+        self._lock = threading.Lock()
+
+    def load_factor(self):
+        load = (SYSTEM.snapshot.get("system") or {}).get("load_average")
+        return max(1.0, load[0] / self._cpus) if load else 1.0
+
+    def next_delay(self, poller, requested=None):
+        """Seconds the poller should wait before its next poll.
+
+        requested is the poller's own interval, if it sent one.
+        """
+        now = time.monotonic()
+        with self._lock:
+            # Re-inserting keeps the dict in least recently seen order
+            self._pollers.pop(poller, None)
+            self._pollers[poller] = now
+            if len(self._pollers) > MAX_POLLERS:
+                del self._pollers[next(iter(self._pollers))]
+            while self._expiry and self._expiry[0][0] < now:
+                expires, expired = heapq.heappop(self._expiry)
+                if self._pollers.get(expired) == expires:
+                    del self._pollers[expired]
+            pollers = len(self._pollers)
+
+            if requested:
+                requested = min(requested,
+                                MAX_POLL_INTERVAL_FACTOR * self.interval)
+            interval = (requested or self.interval) * self.load_factor()
+            if ADMISSION.rate:
+                interval = max(interval, pollers / ADMISSION.rate)
+            self._pollers[poller] = now + 2 * interval
+            heapq.heappush(self._expiry, (now + 2 * interval, poller))
+            if len(self._expiry) > 2 * MAX_POLLERS:
+                # Mostly superseded entries; keep only the live ones
+                self._expiry = [(expires, poller) for poller, expires
+                                in self._pollers.items()]
+                heapq.heapify(self._expiry)
+            self._phase = (self._phase + 1 / pollers) % 1.0
+            delay = (self._phase * interval - now) % interval
+        return delay + interval if delay < interval / 2 else delay
+
+
+def parse_interval(value):
+    """Positive, finite seconds from a header value, or None"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if 0 < seconds < float("inf") else None
+
+
+PACER = Pacer()
+
+
+def wants_keep_alive(version, connection):
+    """Whether a request asks for the connection to stay open"""
+    connection = connection.lower()
+    if version >= "HTTP/1.1":
+        return connection != "close"
+    return connection == "keep-alive"
+
+
+def client_host(address):
+    """Client address used for per-client limits and pacing.
+
+    Peers on a Unix socket have no address and all share "".
+    """
+    return address[0] if isinstance(address, tuple) else ""
+
+
+def unix_listener(path, backlog=DEFAULT_BACKLOG):
+    """A listening Unix stream socket at path, replacing a stale one.
+
+    A socket file is only stale when connecting to it is refused. If a
+    server still accepts on it the process exits instead, the way binding
+    a TCP port in use fails.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                # A listener with a full backlog makes connect() wait
+                probe.settimeout(1)
+                try:
+                    probe.connect(path)
+                except ConnectionRefusedError:
+                    os.unlink(path)
+                except TimeoutError:
+                    sys.exit(f"--unix {path}: a server is listening there "
+                             f"but not accepting")
+                else:
+                    sys.exit(f"--unix {path}: another server is already "
+                             f"listening there")
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+
+class RequestError(Exception):
+    """A request the server answers with status and then hangs up on"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def response_bytes(status, headers, body, keep_alive):
+    """Serialize a response; headers are (name, value) pairs.
+
+    A body of None means the body follows unframed until the connection
+    closes (/stream), so no Content-Length is sent.
+    """
+    if body is None:
+        body = b""
+    elif has_body(status):
+        headers = [*headers, ("Content-Length", len(body))]
+    return (f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+            f"Server: {SERVER_SOFTWARE}\r\n"
+            f"Date: {CLOCK.http_date()}\r\n"
+            + "".join(f"{name}: {value}\r\n" for name, value in headers)
+            + f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode("latin-1") + body
+
+
+def error_response(error):
+    return response_bytes(error.status, [("Content-type", "text/plain")],
+                          str(error).encode(), False)
+
+
+class RequestBuffer:
+    """Request heads read off a socket through one reusable buffer.
+
+    The buffer is allocated once per connection and holds at most
+    MAX_HEAD_BYTES. Bytes past the end of a head, i.e. pipelined requests,
+    stay in it for the next call, so the only copy made is of the head.
+    """
+
+    def __init__(self, sock, size=MAX_HEAD_BYTES):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = self.end = 0
+
+    def empty(self):
+        """Whether no bytes of a further request have been received"""
+        return self.start == self.end
+
+    def discard(self, length):
+        """Skip length bytes of request body; returns False at EOF"""
+        buffered = min(length, self.end - self.start)
+        self.start += buffered
+        if self.start == self.end:
+            self.start = self.end = 0
+        length -= buffered
+        # Whatever is left is past the buffered bytes, so the buffer is
+        # empty and can take it
+        while length:
+            received = self.sock.recv_into(self.view,
+                                           min(length, len(self.buffer)))
+            if not received:
+                return False
+            length -= received
+        return True
+
+    def read_head(self):
+        """The next request head without its blank line, or None at EOF.
+
+        Raises RequestError for a head that doesn't fit in the buffer.
+        """
+        scanned = self.start
+        while True:
+            found = self.buffer.find(b"\r\n\r\n", scanned, self.end)
+            if found >= 0:
+                head = bytes(self.view[self.start:found])
+                self.start = found + 4
+                if self.start == self.end:
+                    self.start = self.end = 0
+                return head
+            # The terminator may straddle what has arrived so far
+            scanned = max(self.start, self.end - 3)
+            if self.end == len(self.buffer):
+                if self.start == 0:
+                    raise RequestError(431, "Request head too large")
+                pending = self.end - self.start
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                scanned -= self.start
+                self.start, self.end = 0, pending
+            received = self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return None
+            self.end += received
+
+
+class InfoHandler(socketserver.BaseRequestHandler):
+    """Serves the requests on one connection for the socketserver engines.
+
+    Connections are persistent (HTTP/1.1) and pipelined requests are read
+    one after another from the RequestBuffer. Heads are split by
+    parse_head into a plain dict, the same as in the asyncio engine,
+    rather than going through http.server and email.parser. Between
+    requests a server that parks idle connections (PooledServer) gets the
+    handler back with idle set, and calls handle() again on the next
+    request; otherwise the connection holds its worker while it waits, so
+    it is only kept open when the server says others aren't waiting.
+    """
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests = MAX_KEEPALIVE_REQUESTS
+    # /stream subscribers this engine lets hold a worker at once
+    max_subscribers = 0
+
+    def setup(self):
+        self.request.settimeout(self.timeout)
+        if self.request.family != socket.AF_UNIX:
+            # Responses go out in one write, but /stream frames follow each
+            # other and must not wait for the client's delayed ACK (~40ms)
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                    True)
+        self.buffer = RequestBuffer(self.request)
+        self.client = client_host(self.client_address)
+        self.served = 0
+
+    def handle(self):
+        self.idle = False
+        try:
+            while self.served < self.max_requests:
+                if self.served and self.buffer.empty() and \
+                        not self.server.wait_for_request(self.request,
+                                                         self.timeout):
+                    self.idle = self.server.parks_idle
+                    return
+                try:
+                    head = self.buffer.read_head()
+                    if head is None:
+                        return
+                    request_line, headers = parse_head(head)
+                    if not self.buffer.discard(body_length(headers)):
+                        return
+                except RequestError as e:
+                    self.request.sendall(error_response(e))
+                    ACCESS_LOG.log(e.status, "%s", e)
+                    return
+                self.served += 1
+                may_keep_alive = (self.served < self.max_requests
+                                  and self.server.may_keep_alive())
+                if not self.handle_request(request_line, headers,
+                                           may_keep_alive):
+                    return
+        except OSError:
+            # Timed out waiting for the next request, or the client left
+            pass
+
+    def handle_request(self, request_line, headers, may_keep_alive):
+        """Answer one request; returns whether the connection stays open"""
+        started = METRICS.start()
+        method, path, version = request_line.split()
+        keep_alive = may_keep_alive and wants_keep_alive(
+            version, headers.get("connection", ""))
+        route = path.partition("?")[0]
+        status, body = 500, b""
+        try:
+            with ADMISSION.request(self.client, route) as rejection:
+                if rejection is not None:
+                    status, response_headers, body = rejection
+                elif method != "GET":
+                    status, response_headers = 501, [("Content-type",
+                                                      "text/plain")]
+                    body = f"Unsupported method ({method!r})".encode()
+                elif route == "/stream":
+                    if not STREAM.subscribe(self.max_subscribers):
+                        status, response_headers, body = shed(
+                            503, STREAM_INTERVAL,
+                            "Too many /stream subscribers for this engine; "
+                            "use --engine asyncio or selectors")
+                    else:
+                        status = 200
+                        self.stream_events(request_line)
+                        return False
+                else:
+                    status, response_headers, body = handle_get(
+                        path, headers, self.client)
+                self.request.sendall(response_bytes(
+                    status, response_headers, body, keep_alive))
+        finally:
+            METRICS.finish(started, path, status, len(body))
+        ACCESS_LOG.log(status, '"%s" %s -', request_line, status)
+        return keep_alive
+
+    def stream_events(self, request_line):
+        """Push snapshots as server-sent events until the client leaves.
+
+        The stream is delimited by closing the connection, and it keeps a
+        worker thread for as long as the client stays subscribed, which is
+        why handle_request() caps subscribers at max_subscribers and only
+        calls this once STREAM has counted the new one.
+        """
+        try:
+            self.request.sendall(response_bytes(
+                200, [("Content-type", "text/event-stream"),
+                      ("Cache-Control", "no-cache")], None, False))
+            ACCESS_LOG.log(200, '"%s" %s -', request_line, 200)
+
+            seq, frame = STREAM.seq, STREAM.frame
+            while frame is not None:
+                if frame:
+                    self.request.sendall(frame)
+                seq, frame = STREAM.wait(seq)
+        except OSError:
+            pass
+        finally:
+            STREAM.unsubscribe()
+
+
+class SerialServer(socketserver.TCPServer):
+    """One connection at a time, the original behaviour.
+
+    With sock, serves that already listening socket (the Unix socket from
+    unix_listener()) instead of binding server_address.
+    """
+    allow_reuse_address = True
+    parks_idle = False
+
+    def __init__(self, server_address, handler_class, backlog=DEFAULT_BACKLOG,
+                 reuse_port=False, sock=None):
+        self.request_queue_size = backlog
+        self.reuse_port = reuse_port
+        if sock is None:
+            super().__init__(server_address, handler_class)
+            return
+        self.address_family = sock.family
+        super().__init__(server_address, handler_class,
+                         bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_address = sock.getsockname()
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def may_keep_alive(self):
+        """Whether the connection being served may stay open.
+
+        Only when no other connection is waiting to be accepted, so that
+        pollers on persistent connections take turns as before.
+        """
+        return not select.select([self.socket], [], [], 0)[0]
+
+    def wait_for_request(self, sock, timeout):
+        """Wait for the next request on a kept-alive connection.
+
+        Returns False, so the connection is closed, when another one is
+        queued after KEEPALIVE_GRACE or none arrives within timeout.
+        """
+        grace = min(KEEPALIVE_GRACE, timeout)
+        if select.select([sock], [], [], grace)[0]:
+            return True
+        readable = select.select([sock, self.socket], [], [],
+                                 timeout - grace)[0]
+        return sock in readable
+
+
+class PooledServer(SerialServer):
+    """Hands each accepted connection to a bounded pool of worker threads.
+
+    When every worker is busy a new connection waits for one, and the ones
+    behind it in the kernel backlog, unless --max-in-flight asks for load
+    to be shed: then the accept thread answers it itself with
+    shed_connection(). A worker only holds a connection while it has a
+    request to answer. Between requests the connection is parked with the
+    keepalive thread, which watches every idle one with a selector, hands
+    it back to the pool once its next request arrives and closes it after
+    the keep-alive timeout, so idle pollers cost a socket, not a worker.
+    """
+    # Idle connections are parked rather than waited on in a worker
+    parks_idle = True
+
+    def __init__(self, server_address, handler_class, workers=DEFAULT_WORKERS,
+                 backlog=DEFAULT_BACKLOG, reuse_port=False, sock=None):
+        self.slots = threading.BoundedSemaphore(workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers,
+                                       thread_name_prefix="worker")
+        # Handlers parked by workers, picked up by the keepalive thread
+        self.parked = collections.deque()
+        self.waker, self.wake_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.watching = True
+        super().__init__(server_address, handler_class, backlog, reuse_port,
+                         sock)
+        threading.Thread(target=self.watch_idle, name="keepalive",
+                         daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.dispatch(request, client_address)
+
+    def dispatch(self, request, client_address, handler=None):
+        """Give a new connection, or a parked handler, to a worker"""
+        if not ADMISSION.max_in_flight:
+            self.slots.acquire()
+        elif not self.slots.acquire(blocking=False):
+            self.shed_connection(request, client_address)
+            return
+        self.pool.submit(self.process_request_thread, request, client_address,
+                         handler)
+
+    def process_request_thread(self, request, client_address, handler=None):
+        idle = False
+        try:
+            if handler is None:
+                handler = self.RequestHandlerClass(request, client_address,
+                                                   self)
+            else:
+                handler.handle()
+            idle = handler.idle
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if idle:
+                self.park(handler)
+            else:
+                self.shutdown_request(request)
+            self.slots.release()
+
+    def may_keep_alive(self):
+        return True
+
+    def wait_for_request(self, sock, timeout):
+        # Go on at once with a request that is already there; otherwise the
+        # connection is parked
+        return bool(select.select([sock], [], [], 0)[0])
+
+    def park(self, handler):
+        """Hand an idle connection to the keepalive thread"""
+        self.parked.append((handler, time.monotonic() + handler.timeout))
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            # A wake-up is already pending
+            pass
+
+    def watch_idle(self):
+        """Body of the keepalive thread.
+
+        Handlers wait in a selector until their connection is readable,
+        when they are dispatched again, or until their deadline. They all
+        share one timeout, so deadlines are in parking order and only the
+        oldest needs checking.
+        """
+        deadlines = {}
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.waker, selectors.EVENT_READ)
+            while self.watching:
+                timeout = None
+                if deadlines:
+                    timeout = max(0, next(iter(deadlines.values()))
+                                  - time.monotonic())
+                for key, _ in selector.select(timeout):
+                    handler = key.data
+                    if handler is None:
+                        self.take_parked(selector, deadlines)
+                        continue
+                    selector.unregister(handler.request)
+                    del deadlines[handler]
+                    self.dispatch(handler.request, handler.client_address,
+                                  handler)
+                now = time.monotonic()
+                while deadlines:
+                    handler, deadline = next(iter(deadlines.items()))
+                    if deadline > now:
+                        break
+                    del deadlines[handler]
+                    selector.unregister(handler.request)
+                    self.shutdown_request(handler.request)
+            for handler in deadlines:
+                self.shutdown_request(handler.request)
+        self.waker.close()
+        self.wake_writer.close()
+
+    def take_parked(self, selector, deadlines):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.parked:
+            handler, deadline = self.parked.popleft()
+            selector.register(handler.request, selectors.EVENT_READ, handler)
+            deadlines[handler] = deadline
+
+    def shed_connection(self, request, client_address):
+        """Answer a connection no worker is free for, on the accept thread.
+
+        Only the part of the request that has already arrived is read, so
+        a slow client can't stall accepting. A prioritized /healthz is
+        answered; anything else gets a 503 with Retry-After.
+        """
+        started = METRICS.start()
+        request_line, path = "-", "-"
+        status, body = 503, b""
+        try:
+            request.setblocking(False)
+            try:
+                head = request.recv(MAX_HEAD_BYTES)
+            except BlockingIOError:
+                head = b""
+            parts = head.partition(b"\r\n")[0].decode("latin-1").split()
+            if len(parts) == 3:
+                request_line, path = " ".join(parts), parts[1]
+            if parts[:1] == ["GET"] and \
+                    ADMISSION.prioritized(path.partition("?")[0]):
+                status, response_headers, body = handle_get(
+                    path, {}, client_host(client_address))
+            else:
+                status, response_headers, body = shed(
+                    503, 1, "No free worker")
+            request.send(response_bytes(status, response_headers, body,
+                                        False))
+        except OSError:
+            pass
+        finally:
+            METRICS.finish(started, path, status, len(body))
+            self.shutdown_request(request)
+        ACCESS_LOG.log(status, '"%s" %s -', request_line, status)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+        self.watching = False
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass
+
+
+def parse_head(head):
+    """Split a raw request head into its request line and header dict.
+
+    Header names are lower-cased. Raises RequestError for a request line
+    that isn't "METHOD target HTTP/x.y" or more than MAX_HEADERS headers.
+    """
+    lines = head.decode("latin-1").split("\r\n")
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+        raise RequestError(400, f"Bad request line {lines[0][:100]!r}")
+    if len(lines) > MAX_HEADERS + 1:
+        raise RequestError(431, f"More than {MAX_HEADERS} header fields")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+def body_length(headers):
+    """Bytes of body following a request head with these headers.
+
+    The body has to be skipped before the next request on the connection
+    is read, or its bytes would be taken for one. Raises RequestError for
+    a body that can't be framed that way or exceeds MAX_BODY_BYTES.
+    """
+    if "transfer-encoding" in headers:
+        raise RequestError(501, "Transfer-Encoding is not supported")
+    value = headers.get("content-length")
+    if value is None:
+        return 0
+    if not value.isdigit() or not value.isascii():
+        raise RequestError(400, f"Bad Content-Length {value[:100]!r}")
+    length = int(value)
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, f"Request body over {MAX_BODY_BYTES} bytes")
+    return length
+
+
+async def stream_events(reader, writer, subscribers, request_line):
+    """Register a /stream subscriber with the event loop's fan-out.
+
+    The connection is written to by fan_out() only, so an idle subscriber
+    costs no task wake-ups; this coroutine just waits for the client to
+    hang up.
+    """
+    started = METRICS.start()
+    writer.write(response_bytes(
+        200, [("Content-type", "text/event-stream"),
+              ("Cache-Control", "no-cache")], None, False) + STREAM.frame)
+    ACCESS_LOG.log(200, '"%s" %s -', request_line, 200)
+
+    subscribers.add(writer)
+    STREAM.subscribe()
+    try:
+        while await reader.read(4096):
+            pass
+    finally:
+        STREAM.unsubscribe()
+        subscribers.discard(writer)
+        METRICS.finish(started, "/stream", 200, 0)
+
+
+def fan_out(subscribers, frame):
+    """Write one snapshot frame to every subscriber of this event loop"""
+    for writer in list(subscribers):
+        if writer.transport.get_write_buffer_size() > STREAM_BUFFER_LIMIT:
+            writer.close()
+        else:
+            writer.write(frame)
+
+
+async def handle_connection(reader, writer, slots, keepalive_timeout,
+                            max_requests, subscribers):
+    """Serve requests on an asyncio stream until either side closes it.
+
+    Pipelined requests are already sitting in the reader's buffer and are
+    answered in order. A worker slot is only held while a request is being
+    answered, so idle keep-alive connections cost nothing but a socket.
+    Requests shed by ADMISSION, and prioritized ones, don't wait for a slot.
+    """
+    client = client_host(writer.get_extra_info("peername"))
+    served = 0
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"),
+                                              keepalive_timeout)
+                request_line, headers = parse_head(head[:-4])
+                length = body_length(headers)
+                if length:
+                    await asyncio.wait_for(reader.readexactly(length),
+                                           keepalive_timeout)
+            except asyncio.LimitOverrunError:
+                error = RequestError(431, "Request head too large")
+            except RequestError as e:
+                error = e
+            else:
+                error = None
+            if error is not None:
+                writer.write(error_response(error))
+                await writer.drain()
+                ACCESS_LOG.log(error.status, "%s", error)
+                break
+            method, path, version = request_line.split()
+            served += 1
+            keep_alive = (served < max_requests and
+                          wants_keep_alive(version, headers.get("connection", "")))
+            route = path.partition("?")[0]
+
+            with ADMISSION.request(client, route) as rejection:
+                if (rejection is None and method == "GET" and
+                        route == "/stream"):
+                    await stream_events(reader, writer, subscribers,
+                                        request_line)
+                    break
+                if rejection is not None or ADMISSION.prioritized(route):
+                    slot = contextlib.nullcontext()
+                else:
+                    slot = slots
+                async with slot:
+                    started = METRICS.start()
+                    if rejection is not None:
+                        status, response_headers, body = rejection
+                    elif method == "GET":
+                        status, response_headers, body = handle_get(
+                            path, headers, client)
+                    else:
+                        status = 501
+                        body = f"Unsupported method ({method!r})".encode()
+                        response_headers = [("Content-type", "text/plain")]
+                    writer.write(response_bytes(status, response_headers,
+                                                body, keep_alive))
+                    try:
+                        await writer.drain()
+                    finally:
+                        METRICS.finish(started, path, status, len(body))
+            ACCESS_LOG.log(status, '"%s" %s -', request_line, status)
+
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ConnectionError):
+        pass
+    except asyncio.CancelledError:
+        # Shutdown; the connection is simply dropped
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_asyncio(port, workers, backlog,
+                        keepalive_timeout=KEEPALIVE_TIMEOUT,
+                        max_requests=MAX_KEEPALIVE_REQUESTS, reuse_port=False,
+                        unix_sock=None):
+    """Serve TCP on port (unless None) and the Unix socket unix_sock"""
+    slots = asyncio.Semaphore(workers)
+    loop = asyncio.get_running_loop()
+    subscribers = set()
+    STREAM.add_listener(
+        lambda frame: loop.call_soon_threadsafe(fan_out, subscribers, frame))
+
+    def handler(reader, writer):
+        return handle_connection(reader, writer, slots, keepalive_timeout,
+                                 max_requests, subscribers)
+
+    # Stop serving on SIGTERM instead of being torn down mid-callback
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set_result, None)
+    async with contextlib.AsyncExitStack() as servers:
+        if port is not None:
+            await servers.enter_async_context(await asyncio.start_server(
+                handler, host="", port=port, backlog=backlog,
+                reuse_address=True, reuse_port=reuse_port,
+                limit=MAX_HEAD_BYTES))
+        if unix_sock is not None:
+            await servers.enter_async_context(await asyncio.start_unix_server(
+                handler, sock=unix_sock, limit=MAX_HEAD_BYTES))
+        await stopped
+
+
+class TimerWheel:
+    """Idle deadlines hashed into one-tick slots around a ring.
+
+    A connection is filed under the slot its deadline falls in and is not
+    moved when it sees activity, so touching it is a single attribute
+    store. When a slot comes due its connections are either expired or, if
+    their deadline has moved on since, filed again further round.
+    """
+
+    def __init__(self, timeout, tick=WHEEL_TICK):
+        self.tick = tick
+        self.slots = [set() for _ in range(int(timeout / tick) + 2)]
+        self.current = int(time.monotonic() / tick)
+
+    def add(self, connection):
+        index = max(int(connection.deadline / self.tick), self.current + 1)
+        connection.slot = self.slots[index % len(self.slots)]
+        connection.slot.add(connection)
+
+    def remove(self, connection):
+        if connection.slot is not None:
+            connection.slot.discard(connection)
+            connection.slot = None
+
+    def expire(self, now):
+        """Connections whose deadline passed, taken off the wheel"""
+        expired = []
+        target = int(now / self.tick)
+        self.current = max(self.current, target - len(self.slots))
+        while self.current < target:
+            self.current += 1
+            index = self.current % len(self.slots)
+            slot, self.slots[index] = self.slots[index], set()
+            for connection in slot:
+                connection.slot = None
+                if connection.deadline <= now:
+                    expired.append(connection)
+                else:
+                    self.add(connection)
+        return expired
+
+
+class EventConnection:
+    """A client connection of the selectors engine.
+
+    Incoming bytes collect in inbuf until a whole request head is there.
+    Responses are appended to outbuf, the connection's write queue, and
+    sent as far as the socket takes them; the rest goes out when the
+    socket is writable again, and no more requests are read meanwhile.
+    Both buffers are trimmed from the front as they are consumed, so an
+    idle keep-alive connection holds little beyond its socket and this
+    small __slots__ object.
+    """
+
+    __slots__ = ("server", "sock", "client", "inbuf", "outbuf", "served",
+                 "deadline", "slot", "events", "closing", "streaming",
+                 "closed")
+
+    def __init__(self, server, sock, client):
+        self.server = server
+        self.sock = sock
+        self.client = client
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.served = 0
+        self.deadline = 0.0
+        self.slot = None
+        self.events = selectors.EVENT_READ
+        self.closing = False
+        self.streaming = False
+        self.closed = False
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            return self.close()
+        if not data:
+            return self.close()
+        if self.streaming:
+            # Nothing is expected from a subscriber but its hang-up
+            return
+        self.server.touch(self)
+        self.inbuf += data
+        self.process()
+        self.flush()
+
+    def on_writable(self):
+        self.flush()
+
+    def process(self):
+        """Answer every complete request waiting in inbuf.
+
+        A request is complete once its head and the body it announces
+        have arrived; the body is dropped unread. Nothing is read while
+        outbuf has bytes waiting, so inbuf never holds more than one
+        recv() worth of pipelined requests beyond a partly received body.
+        """
+        while not self.closing and not self.streaming:
+            end = self.inbuf.find(b"\r\n\r\n")
+            if end < 0 or end > MAX_HEAD_BYTES:
+                if end > MAX_HEAD_BYTES or len(self.inbuf) > MAX_HEAD_BYTES:
+                    self.fail(RequestError(431, "Request head too large"))
+                return
+            head = bytes(self.inbuf[:end])
+            try:
+                request_line, headers = parse_head(head)
+                length = body_length(headers)
+            except RequestError as e:
+                return self.fail(e)
+            if len(self.inbuf) < end + 4 + length:
+                # The head is parsed again once the body is all there
+                return
+            del self.inbuf[:end + 4 + length]
+            self.served += 1
+            self.answer(request_line, headers)
+
+    def answer(self, request_line, headers):
+        method, path, version = request_line.split()
+        keep_alive = (self.served < self.server.max_requests and
+                      wants_keep_alive(version, headers.get("connection", "")))
+        route = path.partition("?")[0]
+        started = METRICS.start()
+        status, body = 500, b""
+        try:
+            with ADMISSION.request(self.client, route) as rejection:
+                if rejection is not None:
+                    status, response_headers, body = rejection
+                elif method != "GET":
+                    status, response_headers = 501, [("Content-type",
+                                                      "text/plain")]
+                    body = f"Unsupported method ({method!r})".encode()
+                elif route == "/stream":
+                    status = 200
+                    self.subscribe()
+                    response_headers, body, keep_alive = None, None, False
+                else:
+                    status, response_headers, body = handle_get(
+                        path, headers, self.client)
+                if response_headers is not None:
+                    self.outbuf += response_bytes(status, response_headers,
+                                                  body, keep_alive)
+        finally:
+            METRICS.finish(started, path, status, len(body or b""))
+        ACCESS_LOG.log(status, '"%s" %s -', request_line, status)
+        if not keep_alive:
+            self.closing = True
+
+    def subscribe(self):
+        """Turn the connection into a /stream subscriber"""
+        self.outbuf += response_bytes(
+            200, [("Content-type", "text/event-stream"),
+                  ("Cache-Control", "no-cache")], None, False) + STREAM.frame
+        self.streaming = True
+        self.server.wheel.remove(self)
+        self.server.subscribers.add(self)
+        STREAM.subscribe()
+
+    def fail(self, error):
+        self.outbuf += error_response(error)
+        ACCESS_LOG.log(error.status, "%s", error)
+        self.closing = True
+
+    def flush(self):
+        """Send what the socket takes from outbuf, then wait for the rest"""
+        if self.closed:
+            return
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                return self.close()
+            del self.outbuf[:sent]
+        if not self.outbuf and self.closing and not self.streaming:
+            return self.close()
+        if self.outbuf:
+            events = selectors.EVENT_WRITE
+            if self.streaming:
+                events |= selectors.EVENT_READ
+        else:
+            events = selectors.EVENT_READ
+        if events != self.events:
+            self.events = events
+            self.server.selector.modify(self.sock, events, self)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.wheel.remove(self)
+        if self.streaming:
+            self.server.subscribers.discard(self)
+            STREAM.unsubscribe()
+        self.server.selector.unregister(self.sock)
+        self.sock.close()
+
+
+class SelectorServer:
+    """Every connection served from one thread by a selectors event loop.
+
+    Sockets are non-blocking and registered with the platform's best
+    selector (epoll on Linux). There are no threads or tasks per
+    connection: EventConnection objects carry all per-connection state and
+    a TimerWheel closes the ones that stay idle longer than the keep-alive
+    timeout. /stream frames published by the stream thread are handed over
+    through a socketpair that wakes the loop.
+    """
+
+    def __init__(self, port, backlog=DEFAULT_BACKLOG,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 max_requests=MAX_KEEPALIVE_REQUESTS, reuse_port=False,
+                 unix_sock=None):
+        self.keepalive_timeout = keepalive_timeout
+        self.max_requests = max_requests
+        self.selector = selectors.DefaultSelector()
+        self.wheel = TimerWheel(keepalive_timeout)
+        self.subscribers = set()
+        self.frames = collections.deque()
+
+        # TCP on port unless it is None, and the Unix socket unix_sock
+        self.listeners = []
+        if port is not None:
+            self.listeners.append(socket.create_server(
+                ("", port), backlog=backlog, reuse_port=reuse_port))
+        if unix_sock is not None:
+            self.listeners.append(unix_sock)
+        for listener in self.listeners:
+            listener.setblocking(False)
+            self.selector.register(
+                listener, selectors.EVENT_READ,
+                lambda listener=listener: self.accept(listener))
+        self.waker, self.wake_writer = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ,
+                               self.fan_out)
+        STREAM.add_listener(self.publish)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server_close()
+
+    def serve_forever(self):
+        while True:
+            for key, mask in self.selector.select(self.wheel.tick):
+                if isinstance(key.data, EventConnection):
+                    if mask & selectors.EVENT_READ:
+                        key.data.on_readable()
+                    if mask & selectors.EVENT_WRITE:
+                        key.data.on_writable()
+                else:
+                    key.data()
+            for connection in self.wheel.expire(time.monotonic()):
+                connection.close()
+
+    def accept(self, listener):
+        while True:
+            try:
+                sock, address = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of file descriptors or the like; try again next time
+                ACCESS_LOG.log(None, "accept failed: %s", e)
+                return
+            sock.setblocking(False)
+            if sock.family != socket.AF_UNIX:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            connection = EventConnection(self, sock, client_host(address))
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            self.touch(connection)
+
+    def touch(self, connection):
+        """Push back the connection's idle deadline"""
+        connection.deadline = time.monotonic() + self.keepalive_timeout
+        if connection.slot is None:
+            self.wheel.add(connection)
+
+    def publish(self, frame):
+        """Queue a /stream frame; called on the stream thread"""
+        self.frames.append(frame)
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            # A wake-up is already pending
+            pass
+
+    def fan_out(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.frames:
+            frame = self.frames.popleft()
+            for connection in list(self.subscribers):
+                if len(connection.outbuf) > STREAM_BUFFER_LIMIT:
+                    # Not reading; drop it instead of queueing without end
+                    connection.close()
+                    continue
+                connection.outbuf += frame
+                connection.flush()
+
+    def server_close(self):
+        for key in list(self.selector.get_map().values()):
+            if isinstance(key.data, EventConnection):
+                key.data.close()
+        self.selector.close()
+        for listener in self.listeners:
+            listener.close()
+        self.waker.close()
+        self.wake_writer.close()
+
+
+def serve(args, reuse_port=False, unix_sock=None):
+    """Run the selected engine in this process until it is killed.
+
+    unix_sock is the listening socket for --unix when a pre-fork parent
+    has already created it; otherwise it is created (and removed) here.
+    """
+    global DEFAULT_FORMAT
+    DEFAULT_FORMAT = args.format
+    CLOCK.tick = args.clock_tick
+    SYSTEM.interval = args.sample_interval
+    SYSTEM.history_length = args.history
+    SYSTEM.sample()
+    SYSTEM.start()
+    load_templates()
+    InfoHandler.timeout = args.keepalive_timeout
+    InfoHandler.max_requests = args.max_requests
+    # The serial engine has no worker to spare for a subscriber
+    if args.engine == "threads":
+        InfoHandler.max_subscribers = max(
+            1, int(args.max_workers * STREAM_WORKER_SHARE))
+    ADMISSION.max_in_flight = args.max_in_flight
+    ADMISSION.rate = args.rate_limit
+    ADMISSION.burst = args.rate_burst
+    ADMISSION.client_rate = args.client_rate_limit
+    ADMISSION.client_burst = args.client_burst
+    ADMISSION.healthz_priority = args.healthz_priority
+    PACER.interval = args.poll_interval
+    ACCESS_LOG.sample = args.log_sample
+    ACCESS_LOG.batch_size = args.log_batch
+    ACCESS_LOG.flush_interval = args.log_flush_interval
+    ACCESS_LOG.start()
+    STREAM.interval = args.stream_interval
+    STREAM.start()
+    if args.shm:
+        SHARED_SNAPSHOT.interval = args.shm_interval
+        SHARED_SNAPSHOT.open(args.shm)
+        SHARED_SNAPSHOT.start()
+
+    owns_unix_sock = args.unix and unix_sock is None
+    if owns_unix_sock:
+        unix_sock = unix_listener(args.unix, args.backlog)
+    port = args.port if args.tcp else None
+
+    # Exit through the finally below on SIGTERM too, so that queued access
+    # log lines are written before the process goes away
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.engine == "asyncio":
+            asyncio.run(serve_asyncio(port, args.max_workers,
+                                      args.backlog, args.keepalive_timeout,
+                                      args.max_requests, reuse_port,
+                                      unix_sock))
+        elif args.engine == "selectors":
+            with SelectorServer(port, args.backlog,
+                                args.keepalive_timeout, args.max_requests,
+                                reuse_port, unix_sock) as server:
+                server.serve_forever()
+        else:
+            serve_socketserver(args, port, reuse_port, unix_sock)
+    finally:
+        SYSTEM.close()
+        STREAM.close()
+        SHARED_SNAPSHOT.close()
+        ACCESS_LOG.close()
+        if owns_unix_sock:
+            os.unlink(args.unix)
+
+
+def serve_socketserver(args, port, reuse_port, unix_sock):
+    """Run the serial or threads engine on each listener.
+
+    With both TCP and a Unix socket, the Unix server runs on a thread of
+    its own (with its own worker pool under threads).
+    """
+    def make_server(address, sock=None):
+        if args.engine == "threads":
+            return PooledServer(address, InfoHandler, args.max_workers,
+                                args.backlog, reuse_port, sock)
+        return SerialServer(address, InfoHandler, args.backlog, reuse_port,
+                            sock)
+
+    servers = []
+    if port is not None:
+        servers.append(make_server(("", port)))
+    if unix_sock is not None:
+        servers.append(make_server(None, unix_sock))
+    try:
+        for server in servers[1:]:
+            threading.Thread(target=server.serve_forever, name="unix",
+                             daemon=True).start()
+        servers[0].serve_forever()
+    finally:
+        for server in servers:
+            server.server_close()
+
+
+def run_worker(args, index, cpus, unix_sock):
+    """Body of a forked worker process; never returns"""
+    code = 0
+    try:
+        # Drop the parent's handlers, which signal every sibling worker,
+        # until serve() installs this process's own, then take the
+        # signals spawn() held back
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+        if cpus:
+            cpu = cpus[index % len(cpus)]
+            os.sched_setaffinity(0, {cpu})
+            print(f"Worker {index} (pid {os.getpid()}) pinned to CPU {cpu}")
+        else:
+            print(f"Worker {index} (pid {os.getpid()}) started")
+        if index:
+            # The --shm file takes a single writer
+            args.shm = None
+        serve(args, reuse_port=True, unix_sock=unix_sock)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+
+def run_prefork(args):
+    """Fork args.workers processes sharing the port through SO_REUSEPORT.
+
+    The kernel spreads incoming connections across the workers' listening
+    sockets, so each process runs its own engine on its own core. A Unix
+    socket can't be shared that way, so the parent creates it once and the
+    workers inherit it and all accept from it. The parent only supervises:
+    it restarts workers that die and forwards SIGTERM/SIGINT to them on
+    shutdown.
+    """
+    if args.tcp and not hasattr(socket, "SO_REUSEPORT"):
+        sys.exit("--workers needs SO_REUSEPORT, which this platform lacks")
+    unix_sock = unix_listener(args.unix, args.backlog) if args.unix else None
+
+    cpus = sorted(os.sched_getaffinity(0)) if args.pin_cpus else None
+
+    # Warm up everything a request touches, then move the surviving objects
+    # into the permanent generation. The workers' collectors then never
+    # write to them, so the pages stay shared with the parent after fork.
+    load_templates()
+    render_info()
+    gc.collect()
+    gc.freeze()
+
+    children = {}
+    stopping = False
+
+    def spawn(index):
+        sys.stdout.flush()
+        # Hold shutdown signals until the child is in children, so that
+        # stop() can't miss it
+        signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            run_worker(args, index, cpus, unix_sock)
+        children[pid] = (index, time.monotonic())
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, SHUTDOWN_SIGNALS)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for index in range(args.workers):
+        spawn(index)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started = children.pop(pid)
+        if stopping:
+            continue
+        print(f"Worker {index} (pid {pid}) exited with status "
+              f"{os.waitstatus_to_exitcode(status)}, restarting")
+        if time.monotonic() - started < RESPAWN_DELAY:
+            time.sleep(RESPAWN_DELAY)
+            if stopping:
+                continue
+        spawn(index)
+
+    if unix_sock is not None:
+        unix_sock.close()
+        os.unlink(args.unix)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix", metavar="PATH",
+                        help="also listen on a Unix domain socket at PATH, "
+                             "for clients in the same container or host")
+    parser.add_argument("--tcp", action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help="listen on --port; --no-tcp with --unix serves "
+                             "the Unix socket only (default: %(default)s)")
+    parser.add_argument("--engine", choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="concurrency model (default: %(default)s)")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_WORKERS,
+                        help="connections served concurrently "
+                             "(default: %(default)s)")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help="listen() accept backlog (default: %(default)s)")
+    parser.add_argument("--keepalive-timeout", type=float,
+                        default=KEEPALIVE_TIMEOUT,
+                        help="seconds an idle persistent connection is kept "
+                             "open (default: %(default)s)")
+    parser.add_argument("--max-requests", type=int,
+                        default=MAX_KEEPALIVE_REQUESTS,
+                        help="requests served per connection before it is "
+                             "closed (default: %(default)s)")
+    parser.add_argument("--max-in-flight", type=int, default=0, metavar="N",
+                        help="answer requests beyond N being served at once "
+                             "with 503 (default: no limit)")
+    parser.add_argument("--rate-limit", type=float, default=0, metavar="RPS",
+                        help="requests per second the server admits; excess "
+                             "gets 503 (default: no limit)")
+    parser.add_argument("--rate-burst", type=float, metavar="N",
+                        help="requests admitted back to back above "
+                             "--rate-limit (default: one second's worth)")
+    parser.add_argument("--client-rate-limit", type=float, default=0,
+                        metavar="RPS",
+                        help="requests per second admitted from one client "
+                             "address; excess gets 429 (default: no limit)")
+    parser.add_argument("--client-burst", type=float, metavar="N",
+                        help="requests admitted back to back above "
+                             "--client-rate-limit (default: one second's "
+                             "worth)")
+    parser.add_argument("--healthz-priority", action="store_true",
+                        help="let /healthz bypass every limit and the "
+                             "asyncio worker slots")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between polls that pollers sending "
+                             "X-Poller-Id but no X-Poll-Interval are paced "
+                             "to; 0 disables pacing (default: %(default)s)")
+    parser.add_argument("--format", choices=FORMATS, default=DEFAULT_FORMAT,
+                        help="body encoding when a request doesn't pick one "
+                             "with ?format= (default: %(default)s)")
+    parser.add_argument("--clock-tick", type=float, default=DEFAULT_CLOCK_TICK,
+                        help="seconds a formatted timestamp is reused for "
+                             "(default: %(default)s)")
+    parser.add_argument("--log-sample", type=int, default=1, metavar="N",
+                        help="log 1 in N successful requests; errors are "
+                             "always logged (default: %(default)s)")
+    parser.add_argument("--log-batch", type=int, default=LOG_BATCH_SIZE,
+                        help="queued access log lines that trigger a write "
+                             "(default: %(default)s)")
+    parser.add_argument("--log-flush-interval", type=float,
+                        default=LOG_FLUSH_INTERVAL,
+                        help="seconds between access log writes "
+                             "(default: %(default)s)")
+    parser.add_argument("--sample-interval", type=float,
+                        default=SAMPLE_INTERVAL,
+                        help="seconds between host and process statistics "
+                             "samples (default: %(default)s)")
+    parser.add_argument("--history", type=int, default=HISTORY_LENGTH,
+                        help="samples kept for /batch history windows "
+                             "(default: %(default)s)")
+    parser.add_argument("--stream-interval", type=float,
+                        default=STREAM_INTERVAL,
+                        help="seconds between snapshots pushed to /stream "
+                             "subscribers (default: %(default)s)")
+    parser.add_argument("--shm", metavar="PATH",
+                        help="publish the info snapshot into a memory-"
+                             "mapped file at PATH (e.g. under /dev/shm) "
+                             "for readers on the same host")
+    parser.add_argument("--shm-interval", type=float, default=SHM_INTERVAL,
+                        help="seconds between snapshots written to the "
+                             "--shm file (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="pre-fork this many processes sharing the port "
+                             "through SO_REUSEPORT (default: single process)")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        help="pin each pre-forked worker to its own CPU")
+    args = parser.parse_args(argv)
+    if not args.tcp and not args.unix:
+        parser.error("--no-tcp needs --unix")
+    return args
+
 
 if __name__ == "__main__":
-    with socketserver.TCPServer(("", PORT), InfoHandler) as httpd:
-        print(f"Server starting on port {PORT}")
-        print(f"Hostname: {os.uname().nodename}")
-        httpd.serve_forever()
+    args = parse_args()
+
+    listening = [f"port {args.port}"] if args.tcp else []
+    if args.unix:
+        listening.append(f"unix:{args.unix}")
+    print(f"Server starting on {' and '.join(listening)}")
+    print(f"Hostname: {os.uname().nodename}")
+    print(f"Engine: {args.engine} (max_workers={args.max_workers}, "
+          f"backlog={args.backlog})")
+
+    if args.workers > 0:
+        print(f"Pre-forking {args.workers} worker processes")
+        run_prefork(args)
+    else:
+        serve(args)
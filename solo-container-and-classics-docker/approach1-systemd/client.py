@@ -2,45 +2,839 @@
 """
 Simple HTTP client that periodically polls the server
 """
-import urllib.request
+import asyncio
+import http.client
 import json
+import mmap
+import random
+import signal
+import socket
+import struct
 import time
 import os
 import sys
+from array import array
 from datetime import datetime
 
-# Server location - can be configured via environment variable
+# Server location - can be configured via environment variable.
+# SERVER_HOST=unix:/path/to/server.sock connects to a server started with
+# --unix instead, and SERVER_PORT is then ignored
 SERVER_HOST = os.environ.get("SERVER_HOST", "localhost")
 SERVER_PORT = os.environ.get("SERVER_PORT", "8080")
-POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", "5"))
+# Seconds between polls; fractions are fine, e.g. 0.005 for 5ms, and 0
+# polls back to back
+POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "5"))
+# Each poll is pushed back by a random share of the interval up to this
+# fraction (0-1), so a fleet of clients doesn't poll in lockstep
+POLL_JITTER = float(os.environ.get("POLL_JITTER", "0"))
+# Follow the next-poll delay the server suggests in X-Poll-After instead
+# of the fixed POLL_INTERVAL grid; 0 ignores it. The server paces around
+# POLL_INTERVAL, which is sent along in X-Poll-Interval; a POLL_INTERVAL
+# of 0 (back-to-back polls) is never paced
+POLL_PACING = os.environ.get("POLL_PACING", "1") != "0" and POLL_INTERVAL > 0
+# Send the snapshot version we hold so the server answers with only what
+# changed since, as a JSON merge patch; 0 asks for full bodies
+POLL_DELTAS = os.environ.get("POLL_DELTAS", "1") != "0"
+# Identifies this client to the server's pacing, which spreads pollers
+POLLER_ID = os.urandom(4).hex()
+# "poll" requests the server every POLL_INTERVAL seconds, "stream" keeps
+# one connection to /stream open and receives snapshots as they are pushed,
+# "multi" polls every server in SERVER_TARGETS from one asyncio loop,
+# "shm" reads the snapshot a server on this host publishes with --shm
+CLIENT_MODE = os.environ.get("CLIENT_MODE", "poll")
+# Comma or whitespace separated host:port list for multi mode, or
+# @path to read it from a file; unix:/path entries are Unix sockets;
+# defaults to SERVER_HOST:SERVER_PORT
+SERVER_TARGETS = os.environ.get("SERVER_TARGETS", "")
+# Snapshot file shm mode maps; the server's --shm PATH
+SHM_PATH = os.environ.get("SHM_PATH", "/dev/shm/server-info")
+# Requests multi mode has in flight at once across all targets
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", "100"))
+# Seconds between latency/error-rate summaries of the polls; 0 disables
+STATS_INTERVAL = float(os.environ.get("STATS_INTERVAL", "60"))
+# Append every poll's raw timing to this file as SAMPLE records
+SAMPLES_FILE = os.environ.get("SAMPLES_FILE", "")
+# Seconds samples may sit in the write buffer before they go to
+# SAMPLES_FILE, whatever STATS_INTERVAL is; the rest is written on exit
+SAMPLES_FLUSH_INTERVAL = 1.0
+# Raw sample record: wall-clock time of the poll (epoch seconds), latency
+# in seconds, 1 for success or 0 for an error; little-endian, 17 bytes
+SAMPLE = struct.Struct("<ddB")
+
+# Latency histogram layout: each power-of-two octave of microseconds is
+# split into 2**HISTOGRAM_SUB_BITS buckets, up to 2**HISTOGRAM_OCTAVES us
+HISTOGRAM_SUB_BITS = 2
+HISTOGRAM_OCTAVES = 26
+
+# Layout of the server's --shm file, copied from server.py: magic,
+# sequence number (odd while being written), body length, publish time
+# and publish interval, then the compact info body at SHM_DATA_OFFSET
+SHM_MAGIC = b"INFOSHM1"
+SHM_HEADER = struct.Struct("<8sQIdd")
+SHM_SEQ = struct.Struct("<Q")
+SHM_DATA_OFFSET = 64
+# Attempts to copy a consistent snapshot before a read is given up
+SHM_RETRIES = 1000
+# A snapshot older than this many publish intervals, and at least
+# SHM_STALE_AFTER seconds, is reported as stale
+SHM_STALE_INTERVALS = 3
+SHM_STALE_AFTER = 1.0
+
+# Seconds without any event before a stream is considered dead
+STREAM_TIMEOUT = 30
+REQUEST_TIMEOUT = 5
+# Idle pooled connections older than this are closed instead of reused;
+# kept below the server's default --keepalive-timeout of 15s so a poll
+# rarely picks a socket the server is about to drop
+POOL_IDLE_TIMEOUT = 10
+POOL_MAX_IDLE = 4
+
+
+# Phases a fetch is broken into: name resolution, TCP connect (both only
+# for a new connection), request sent until the response headers are in
+# (server processing plus a round trip), and reading the body; or, in shm
+# mode, copying the snapshot out of shared memory
+PHASES = ("dns", "connect", "ttfb", "body", "read")
+
+
+class TimedHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection that times name resolution and TCP connect apart"""
+
+    timings = {}
+
+    def connect(self):
+        started = time.perf_counter()
+        addresses = socket.getaddrinfo(self.host, self.port,
+                                       type=socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+
+        error = None
+        for _, _, _, _, address in addresses:
+            try:
+                self.sock = socket.create_connection(
+                    address[:2], self.timeout, self.source_address)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timings = {"dns": resolved - started,
+                        "connect": time.perf_counter() - resolved}
+
+
+class UnixHTTPConnection(TimedHTTPConnection):
+    """HTTPConnection to a server's Unix domain socket (--unix PATH)"""
+
+    def __init__(self, path, timeout=REQUEST_TIMEOUT):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        started = time.perf_counter()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.timings = {"connect": time.perf_counter() - started}
+
+
+def unix_path(host):
+    """The socket path for a unix:/path host, or None for a network host"""
+    return host[len("unix:"):] if host.startswith("unix:") else None
+
+
+def open_connection(host, port, timeout=REQUEST_TIMEOUT):
+    """An unconnected HTTPConnection to host, which may be unix:/path"""
+    path = unix_path(host)
+    if path is not None:
+        return UnixHTTPConnection(path, timeout=timeout)
+    return TimedHTTPConnection(host, port, timeout=timeout)
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections reused across requests.
+
+    Saves the TCP handshake, DNS lookup and teardown of a fresh connection
+    on every poll. A GET that fails on a reused connection (the server may
+    have closed it in the meantime) is retried once on a new one, so a
+    dropped socket never surfaces as an error.
+    """
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_idle=POOL_MAX_IDLE):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = {}
+
+    def get(self, host, port, path, headers=None):
+        """GET path; returns (status, reason, headers, body, timings).
+
+        timings maps the PHASES of the request to seconds; dns and connect
+        are only present when a new connection had to be opened.
+        """
+        connection, reused = self._acquire(host, port)
+        try:
+            try:
+                result, will_close = self._send(connection, path, headers)
+            except (ConnectionError, http.client.HTTPException):
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect(host, port)
+                result, will_close = self._send(connection, path, headers)
+        except Exception:
+            connection.close()
+            raise
+
+        if will_close:
+            connection.close()
+        else:
+            self._release(host, port, connection)
+        return result
+
+    def close(self):
+        for idle in self._idle.values():
+            for connection, _ in idle:
+                connection.close()
+        self._idle.clear()
+
+    def _send(self, connection, path, headers):
+        timings = {}
+        if connection.sock is None:
+            connection.connect()
+            timings.update(connection.timings)
+        started = time.perf_counter()
+        connection.request("GET", path, headers=headers or {})
+        response = connection.getresponse()
+        headers_in = time.perf_counter()
+        body = response.read()
+        timings["ttfb"] = headers_in - started
+        timings["body"] = time.perf_counter() - headers_in
+        result = (response.status, response.reason, response.headers, body,
+                  timings)
+        return result, response.will_close
+
+    def _connect(self, host, port):
+        return open_connection(host, port, self.timeout)
+
+    def _acquire(self, host, port):
+        idle = self._idle.get((host, port), [])
+        now = time.monotonic()
+        while idle:
+            connection, released = idle.pop()
+            if now - released < self.idle_timeout:
+                return connection, True
+            connection.close()
+        return self._connect(host, port), False
+
+    def _release(self, host, port, connection):
+        idle = self._idle.setdefault((host, port), [])
+        if len(idle) < self.max_idle:
+            idle.append((connection, time.monotonic()))
+        else:
+            connection.close()
+
+
+POOL = ConnectionPool()
+
+class CachedInfo:
+    """The last info body from one server, with its ETag and version.
+
+    With POLL_DELTAS, polls send the snapshot version back in
+    X-Snapshot-Since and the server answers with a JSON merge patch from
+    that version, which is applied to the cached data; it falls back to a
+    full body when it no longer has our version. Otherwise polls send the
+    ETag back in If-None-Match, and on a 304 the cached data is reused as
+    is. The server's ETag covers its identity fields only, so the
+    timestamp in a reused body is the one from the last full response.
+    """
+
+    def __init__(self):
+        self.etag = None
+        self.version = None
+        self.data = None
+        # Seconds the server asked us to wait before polling again
+        self.poll_after = None
+
+    def request_headers(self):
+        if POLL_DELTAS and self.version:
+            headers = {"X-Snapshot-Since": self.version}
+        else:
+            headers = {"If-None-Match": self.etag} if self.etag else {}
+        if POLL_PACING:
+            headers["X-Poller-Id"] = POLLER_ID
+            headers["X-Poll-Interval"] = f"{POLL_INTERVAL:g}"
+        return headers
+
+    def update(self, status, reason, headers, body):
+        """Returns (data, error, note) for a response.
+
+        note is "not modified" or "delta" when the data was not sent whole.
+        """
+        self.poll_after = parse_poll_after(headers.get("x-poll-after"))
+        if status == 304 and self.data is not None:
+            return self.data, None, "not modified"
+        if status != 200:
+            return None, f"HTTP Error {status}: {reason}", None
+        note = None
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/merge-patch+json"):
+            if self.data is None:
+                self.version = None
+                return None, "Delta response without a cached body", None
+            self.data = apply_merge_patch(self.data, json.loads(body.decode()))
+            note = "delta"
+        else:
+            self.data = json.loads(body.decode())
+            self.etag = headers.get("etag")
+        self.version = headers.get("x-snapshot-version")
+        return self.data, None, note
+
+
+INFO_CACHE = CachedInfo()
+
+
+def apply_merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7396); returns the patched copy"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for name, value in patch.items():
+        if value is None:
+            result.pop(name, None)
+        else:
+            result[name] = apply_merge_patch(result.get(name), value)
+    return result
+
+
+def parse_poll_after(value):
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    return seconds if 0 <= seconds < float("inf") else None
+
 
 def fetch_server_info():
-    """Fetch information from the server"""
-    url = f"http://{SERVER_HOST}:{SERVER_PORT}/"
+    """Fetch information from the server.
+
+    Returns (data, error, timings, note) where note is as for
+    CachedInfo.update().
+    """
+    INFO_CACHE.poll_after = None
     try:
-        with urllib.request.urlopen(url, timeout=5) as response:
-            data = json.loads(response.read().decode())
-            return data, None
+        status, reason, headers, body, timings = POOL.get(
+            SERVER_HOST, SERVER_PORT, "/", INFO_CACHE.request_headers())
+        data, error, note = INFO_CACHE.update(status, reason, headers, body)
+        return data, error, timings, note
     except Exception as e:
-        return None, str(e)
+        return None, str(e), {}, None
+
+def stream_server_info():
+    """Yield (data, error) for every snapshot the server pushes on /stream.
+
+    Returns when the stream ends; an error is yielded if it breaks.
+    """
+    connection = open_connection(SERVER_HOST, SERVER_PORT, STREAM_TIMEOUT)
+    try:
+        connection.request("GET", "/stream")
+        response = connection.getresponse()
+        if response.status != 200:
+            yield None, f"HTTP Error {response.status}: {response.reason}"
+            return
+        for line in response:
+            if line.startswith(b"data:"):
+                yield json.loads(line[5:].decode()), None
+    except Exception as e:
+        yield None, str(e)
+    finally:
+        connection.close()
+
+
+class SnapshotReader:
+    """Reads the info snapshot a local server publishes with --shm.
+
+    The file is mapped once, on the first read, and every read after that
+    copies the body out of the mapping with no syscall. The server writes
+    under a seqlock, so a copy is only kept if the sequence number was even
+    before it and unchanged after it.
+    """
+
+    def __init__(self, path=SHM_PATH):
+        self.path = path
+        self._map = None
+
+    def open(self):
+        with open(self.path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(SHM_MAGIC)] != SHM_MAGIC:
+            self._map.close()
+            self._map = None
+            raise ValueError(f"{self.path} is not a server snapshot file")
+
+    def read(self):
+        """Returns (data, error, timings)"""
+        try:
+            if self._map is None:
+                self.open()
+        except (OSError, ValueError) as e:
+            return None, str(e), {}
+
+        started = time.perf_counter()
+        snapshot = self._map
+        for _ in range(SHM_RETRIES):
+            seq = SHM_SEQ.unpack_from(snapshot, 8)[0]
+            if seq & 1:
+                continue
+            _, _, length, published, interval = \
+                SHM_HEADER.unpack_from(snapshot)
+            body = snapshot[SHM_DATA_OFFSET:SHM_DATA_OFFSET + length]
+            if SHM_SEQ.unpack_from(snapshot, 8)[0] == seq:
+                break
+        else:
+            return None, "Snapshot kept changing while being read", {}
+        timings = {"read": time.perf_counter() - started}
+
+        if not length:
+            return None, "Server is not publishing snapshots", timings
+        age = time.time() - published
+        if age > max(SHM_STALE_INTERVALS * interval, SHM_STALE_AFTER):
+            return (None, f"Snapshot is {age:.1f}s old, is the server "
+                          f"running?", timings)
+        return json.loads(body), None, timings
+
+
+SNAPSHOT_READER = SnapshotReader()
+
+
+class Schedule:
+    """Poll deadlines on a fixed grid of the monotonic clock.
+
+    Poll n is due at start + n * interval, so time spent on requests never
+    accumulates into drift. Jitter delays each poll by a random amount
+    without moving the grid. When a poll overruns one or more deadlines
+    those ticks are skipped and counted instead of being fired back to
+    back. A server's pacing hint moves the grid with follow().
+    """
+
+    def __init__(self, interval, jitter=0.0, start=None):
+        self.interval = interval
+        self.jitter = jitter
+        self.start = time.monotonic() if start is None else start
+        self.tick = -1
+        self.missed = 0
+        self.followed = False
+
+    def follow(self, seconds):
+        """Move the grid so the next poll is due seconds from now.
+
+        The server's hint already spreads pollers out, so that poll gets
+        no jitter.
+        """
+        self.start = time.monotonic() + seconds
+        self.tick = -1
+        self.followed = True
+
+    def delay(self):
+        """Advance to the next tick; returns (seconds to wait, ticks missed).
+
+        An interval of 0 polls back to back, with no ticks to miss.
+        """
+        now = time.monotonic()
+        self.tick += 1
+        due = self.start + self.tick * self.interval
+        missed = 0
+        if self.interval and due + self.interval <= now:
+            missed = int((now - due) / self.interval)
+            self.tick += missed
+            self.missed += missed
+            due = self.start + self.tick * self.interval
+        if self.jitter and not self.followed:
+            due += random.uniform(0, self.jitter * self.interval)
+        self.followed = False
+        return max(0.0, due - now), missed
+
+    def wait(self):
+        """Sleep until the next tick; returns the number of ticks missed"""
+        delay, missed = self.delay()
+        time.sleep(delay)
+        return missed
+
+
+def histogram_index(micros):
+    """Bucket for a latency in whole microseconds"""
+    sub_buckets = 1 << HISTOGRAM_SUB_BITS
+    if micros < sub_buckets:
+        return micros
+    octave = micros.bit_length() - HISTOGRAM_SUB_BITS
+    sub = (micros >> (octave - 1)) & (sub_buckets - 1)
+    return min(octave * sub_buckets + sub, len(HISTOGRAM_BOUNDS) - 1)
+
+
+def histogram_bounds():
+    """Exclusive upper bound of every bucket, in seconds"""
+    sub_buckets = 1 << HISTOGRAM_SUB_BITS
+    bounds = [float(i + 1) for i in range(sub_buckets)]
+    for octave in range(1, HISTOGRAM_OCTAVES - HISTOGRAM_SUB_BITS + 1):
+        for sub in range(sub_buckets):
+            bounds.append(float((sub_buckets + sub + 1) << (octave - 1)))
+    return [bound / 1e6 for bound in bounds]
+
+
+HISTOGRAM_BOUNDS = histogram_bounds()
+
+
+def format_duration(seconds):
+    """Milliseconds, or microseconds below one millisecond"""
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.1f}us"
+    return f"{seconds * 1e3:.2f}ms"
+
+
+class LatencyStats:
+    """Poll latencies in a fixed-bucket histogram, summarized periodically.
+
+    Recording a poll is one array slot increment. Every interval the
+    client prints p50/p95/p99/max and the error rate for the polls since
+    the previous summary, then starts a fresh window. Raw samples go to
+    samples_path, opened on the first one, and are flushed at least every
+    SAMPLES_FLUSH_INTERVAL and by close().
+    """
+
+    def __init__(self, interval=STATS_INTERVAL, samples_path=SAMPLES_FILE):
+        self.interval = interval
+        self.counts = array("Q", bytes(8 * len(HISTOGRAM_BOUNDS)))
+        self.ok = 0
+        self.errors = 0
+        self.max = 0.0
+        self.phases = {}
+        self.window_start = time.monotonic()
+        self.samples_path = samples_path
+        self.samples = None
+        self.samples_flushed = 0.0
+
+    def record(self, latency, ok, timings=None):
+        for phase, seconds in (timings or {}).items():
+            count, total, slowest = self.phases.get(phase, (0, 0.0, 0.0))
+            self.phases[phase] = (count + 1, total + seconds,
+                                  max(slowest, seconds))
+        if ok:
+            self.ok += 1
+            self.counts[histogram_index(int(latency * 1e6))] += 1
+            if latency > self.max:
+                self.max = latency
+        else:
+            self.errors += 1
+        if self.samples_path:
+            self.write_sample(latency, ok)
+
+    def write_sample(self, latency, ok):
+        now = time.monotonic()
+        if self.samples is None:
+            self.samples = open(self.samples_path, "ab")
+            self.samples_flushed = now
+        self.samples.write(SAMPLE.pack(time.time(), latency, ok))
+        if now - self.samples_flushed >= SAMPLES_FLUSH_INTERVAL:
+            self.samples.flush()
+            self.samples_flushed = now
+
+    def close(self):
+        """Write out the buffered samples"""
+        if self.samples is not None:
+            self.samples.close()
+            self.samples = None
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q, capped at the max"""
+        rank = max(1, int(q * self.ok + 0.5))
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def maybe_report(self):
+        if not self.interval or \
+                time.monotonic() - self.window_start < self.interval:
+            return
+        total = self.ok + self.errors
+        timestamp = datetime.now().isoformat()
+        summary = (f"[{timestamp}] STATS: {total} polls, {self.errors} errors "
+                   f"({self.errors / total if total else 0:.1%})")
+        if self.ok:
+            summary += ", latency " + " ".join(
+                f"{name} {format_duration(value)}" for name, value in (
+                    ("p50", self.quantile(0.5)), ("p95", self.quantile(0.95)),
+                    ("p99", self.quantile(0.99)), ("max", self.max)))
+        print(summary)
+        if self.phases:
+            print(f"[{timestamp}] PHASES: " + ", ".join(
+                f"{phase} avg {format_duration(total / count)} "
+                f"max {format_duration(slowest)} ({count}x)"
+                for phase in PHASES if phase in self.phases
+                for count, total, slowest in [self.phases[phase]]))
+
+        self.counts = array("Q", bytes(8 * len(HISTOGRAM_BOUNDS)))
+        self.ok = self.errors = 0
+        self.max = 0.0
+        self.phases = {}
+        self.window_start = time.monotonic()
+
+
+STATS = LatencyStats()
+
+
+class AsyncConnection:
+    """A keep-alive HTTP/1.1 connection to one target for multi mode.
+
+    Like ConnectionPool, it is reopened instead of reused after
+    idle_timeout, and a GET that fails on a reused connection is retried
+    once on a new one. Any other failure, a cancelled wait included,
+    closes it so a late response can't be read as the next poll's.
+    """
+
+    def __init__(self, host, port, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.reader = None
+        self.writer = None
+        self.used = 0.0
+
+    async def get(self, path, headers=None):
+        """GET path; returns (status, reason, headers, body, timings)"""
+        if self.writer is not None and \
+                time.monotonic() - self.used >= self.idle_timeout:
+            self.close()
+        reused = self.writer is not None
+        try:
+            try:
+                result = await self._get(path, headers or {})
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if not reused:
+                    raise
+                result = await self._get(path, headers or {})
+        except BaseException:
+            self.close()
+            raise
+        self.used = time.monotonic()
+        return result
+
+    async def _get(self, path, request_headers):
+        timings = {}
+        if self.writer is None:
+            await self._connect(timings)
+        started = time.perf_counter()
+        host = "localhost" if self.port is None else f"{self.host}:{self.port}"
+        self.writer.write(f"GET {path} HTTP/1.1\r\n"
+                          f"Host: {host}\r\n".encode()
+                          + "".join(f"{name}: {value}\r\n" for name, value
+                                    in request_headers.items()).encode()
+                          + b"\r\n")
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        headers_in = time.perf_counter()
+        status_line, *lines = head.split("\r\n")
+        _, status, reason = status_line.split(" ", 2)
+        headers = {}
+        for line in lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = await self.reader.readexactly(
+            int(headers.get("content-length", 0)))
+        timings["ttfb"] = headers_in - started
+        timings["body"] = time.perf_counter() - headers_in
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return int(status), reason, headers, body, timings
+
+    async def _connect(self, timings):
+        started = time.perf_counter()
+        path = unix_path(self.host)
+        if path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+            timings["connect"] = time.perf_counter() - started
+            return
+        addresses = await asyncio.get_running_loop().getaddrinfo(
+            self.host, self.port, type=socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        error = None
+        for _, _, _, _, address in addresses:
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    *address[:2])
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        timings["dns"] = resolved - started
+        timings["connect"] = time.perf_counter() - resolved
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+def parse_targets(spec):
+    """(host, port) pairs from SERVER_TARGETS; port is None for unix:"""
+    if spec.startswith("@"):
+        with open(spec[1:]) as f:
+            spec = f.read()
+    targets = []
+    for item in spec.replace(",", " ").split():
+        host, _, port = item.rpartition(":")
+        if unix_path(item) is not None:
+            targets.append((item, None))
+        else:
+            targets.append((host, int(port)) if host else (item, 80))
+    if targets:
+        return targets
+    if unix_path(SERVER_HOST) is not None:
+        return [(SERVER_HOST, None)]
+    return [(SERVER_HOST, int(SERVER_PORT))]
+
+
+async def poll_target(host, port, in_flight):
+    """Poll one target on its own schedule until cancelled.
+
+    Each target starts at a random offset into the interval, so that a
+    large target list is spread out rather than fetched in one burst. A
+    slow target only delays its own next poll.
+    """
+    connection = AsyncConnection(host, port)
+    cache = CachedInfo()
+    target = host if port is None else f"{host}:{port}"
+    schedule = Schedule(POLL_INTERVAL, POLL_JITTER,
+                        time.monotonic() + random.uniform(0, POLL_INTERVAL))
+    try:
+        while True:
+            delay, missed = schedule.delay()
+            if missed:
+                report_missed(missed, schedule.missed, target)
+            await asyncio.sleep(delay)
+            async with in_flight:
+                started = time.perf_counter()
+                data, timings, note = None, {}, None
+                cache.poll_after = None
+                try:
+                    response = await asyncio.wait_for(
+                        connection.get("/", cache.request_headers()),
+                        REQUEST_TIMEOUT)
+                    *response, timings = response
+                    data, error, note = cache.update(*response)
+                except asyncio.TimeoutError:
+                    error = "timed out"
+                except Exception as e:
+                    error = str(e) or type(e).__name__
+                STATS.record(time.perf_counter() - started, error is None,
+                             timings)
+                report(data, error, target, timings, note)
+                STATS.maybe_report()
+            if cache.poll_after is not None:
+                schedule.follow(cache.poll_after)
+    finally:
+        connection.close()
+
+
+async def poll_targets(targets):
+    in_flight = asyncio.Semaphore(MAX_IN_FLIGHT)
+    await asyncio.gather(*(poll_target(host, port, in_flight)
+                           for host, port in targets))
+
+
+def report(data, error, target=None, timings=None, note=None):
+    timestamp = datetime.now().isoformat()
+    source = f"Server {target}" if target else "Server"
+    if error:
+        print(f"[{timestamp}] ERROR: {error}" +
+              (f" ({target})" if target else ""))
+    else:
+        print(f"[{timestamp}] SUCCESS: {source} responded" +
+              (f" ({note})" if note else ""))
+        print(f"  Server hostname: {data.get('hostname')}")
+        print(f"  Server message: {data.get('message')}")
+        print(f"  Server timestamp: {data.get('timestamp')}")
+        if timings:
+            print("  Timing: " + ", ".join(
+                f"{phase} {format_duration(timings[phase])}"
+                for phase in PHASES if phase in timings))
+
+
+def report_missed(missed, total, target=None):
+    timestamp = datetime.now().isoformat()
+    print(f"[{timestamp}] WARNING: poll overran its interval, skipped "
+          f"{missed} tick(s), {total} in total" +
+          (f" ({target})" if target else ""))
+
 
 if __name__ == "__main__":
+    if POLL_INTERVAL < 0:
+        sys.exit(f"POLL_INTERVAL must be 0 or more seconds, "
+                 f"not {POLL_INTERVAL:g}")
     print(f"Client starting...")
-    print(f"Server: {SERVER_HOST}:{SERVER_PORT}")
-    print(f"Poll interval: {POLL_INTERVAL}s")
+    if CLIENT_MODE == "multi":
+        targets = parse_targets(SERVER_TARGETS)
+        print(f"Servers: {len(targets)} targets, "
+              f"max {MAX_IN_FLIGHT} requests in flight")
+    elif CLIENT_MODE == "shm":
+        print(f"Snapshot file: {SHM_PATH}")
+    else:
+        print(f"Server: {SERVER_HOST}" + ("" if unix_path(SERVER_HOST)
+                                          else f":{SERVER_PORT}"))
+    print(f"Mode: {CLIENT_MODE}")
+    print(f"Poll interval: {POLL_INTERVAL:g}s"
+          + (f" (jitter {POLL_JITTER:.0%})" if POLL_JITTER else "")
+          + (" (server paced)"
+             if POLL_PACING and CLIENT_MODE != "shm" else ""))
     print(f"Hostname: {os.uname().nodename}")
     print("-" * 60)
 
-    while True:
-        timestamp = datetime.now().isoformat()
-        data, error = fetch_server_info()
-
-        if error:
-            print(f"[{timestamp}] ERROR: {error}")
+    # Exit through the finally below on SIGTERM too (docker stop,
+    # systemctl stop), so buffered samples are written out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if CLIENT_MODE == "multi":
+            asyncio.run(poll_targets(targets))
+        elif CLIENT_MODE == "stream":
+            while True:
+                for data, error in stream_server_info():
+                    report(data, error)
+                # Reconnect after the poll interval when the stream ends
+                time.sleep(POLL_INTERVAL)
+        elif CLIENT_MODE == "shm":
+            schedule = Schedule(POLL_INTERVAL, POLL_JITTER)
+            while True:
+                missed = schedule.wait()
+                if missed:
+                    report_missed(missed, schedule.missed)
+                started = time.perf_counter()
+                data, error, timings = SNAPSHOT_READER.read()
+                STATS.record(time.perf_counter() - started, error is None,
+                             timings)
+                report(data, error, timings=timings)
+                STATS.maybe_report()
         else:
-            print(f"[{timestamp}] SUCCESS: Server responded")
-            print(f"  Server hostname: {data.get('hostname')}")
-            print(f"  Server message: {data.get('message')}")
-            print(f"  Server timestamp: {data.get('timestamp')}")
-
-        time.sleep(POLL_INTERVAL)
+            schedule = Schedule(POLL_INTERVAL, POLL_JITTER)
+            while True:
+                missed = schedule.wait()
+                if missed:
+                    report_missed(missed, schedule.missed)
+                started = time.perf_counter()
+                data, error, timings, note = fetch_server_info()
+                STATS.record(time.perf_counter() - started, error is None,
+                             timings)
+                report(data, error, timings=timings, note=note)
+                STATS.maybe_report()
+                if INFO_CACHE.poll_after is not None:
+                    schedule.follow(INFO_CACHE.poll_after)
+    finally:
+        STATS.close()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+Load generator and benchmark suite for the info server
+
+Runs closed-loop scenarios (a fixed number of connections, each sending
+its next request as soon as the previous answer arrives) and open-loop
+scenarios (requests sent on a fixed schedule whether or not earlier ones
+have been answered). Open-loop latency is measured from the moment a
+request was due, not from when it was actually sent, so a stalled server
+shows up as queueing delay instead of hiding behind a slower request rate
+(coordinated omission).
+
+Results are written as JSON with a stable layout so that runs from two
+commits can be diffed:
+
+    ./bench.py --spawn "--engine threads" --output before.json
+    ./bench.py --spawn "--engine asyncio" --output after.json
+    diff before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_URL = "http://127.0.0.1:8080/"
+DEFAULT_DURATION = 5.0
+DEFAULT_WARMUP = 1.0
+DEFAULT_CLOSED = "1,16,64"
+DEFAULT_OPEN = "200,1000"
+DEFAULT_MAX_CONNECTIONS = 256
+REQUEST_TIMEOUT = 5.0
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "server.py")
+
+
+class Connection:
+    """One keep-alive HTTP/1.1 connection issuing GETs"""
+
+    def __init__(self, host, port, request):
+        self.host = host
+        self.port = port
+        self.request = request
+        self.reader = None
+        self.writer = None
+
+    async def get(self):
+        """Send one request and read the full answer; returns the status"""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        self.writer.write(self.request)
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        status = int(head.split(b" ", 2)[1])
+        length = 0
+        close = False
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection":
+                close = value.strip().lower() == b"close"
+        await self.reader.readexactly(length)
+        if close:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class Recorder:
+    """Latency samples and errors for requests due after the warm-up"""
+
+    def __init__(self, since):
+        self.since = since
+        self.latencies = []
+        self.errors = {}
+
+    def ok(self, due, latency):
+        if due >= self.since:
+            self.latencies.append(latency)
+
+    def error(self, due, kind):
+        if due >= self.since:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+async def timed_get(connection, recorder, due):
+    """Issue one request and record its latency measured from due"""
+    try:
+        status = await asyncio.wait_for(connection.get(), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        connection.close()
+        recorder.error(due, "timeout")
+        return
+    except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+        connection.close()
+        recorder.error(due, type(e).__name__)
+        return
+    if status >= 400:
+        recorder.error(due, f"http_{status}")
+    else:
+        recorder.ok(due, time.perf_counter() - due)
+
+
+async def run_closed(target, concurrency, duration, warmup):
+    """Fixed concurrency: each connection waits for its previous answer"""
+    start = time.perf_counter()
+    recorder = Recorder(start + warmup)
+    deadline = start + warmup + duration
+
+    async def loop():
+        connection = Connection(*target)
+        try:
+            while time.perf_counter() < deadline:
+                await timed_get(connection, recorder, time.perf_counter())
+        finally:
+            connection.close()
+
+    await asyncio.gather(*(loop() for _ in range(concurrency)))
+    return recorder, duration
+
+
+async def run_open(target, rate, duration, warmup, max_connections):
+    """Fixed arrival rate: requests are due on a schedule, answered or not.
+
+    A request that can't get a connection because all of them are busy
+    waits for one, and that wait counts towards its latency. The event
+    loop's timers wake with millisecond granularity, so open-loop latencies
+    include up to about 1ms of generator scheduling delay.
+    """
+    start = time.perf_counter()
+    recorder = Recorder(start + warmup)
+    idle = []
+    available = asyncio.Semaphore(max_connections)
+    interval = 1.0 / rate
+    tasks = set()
+
+    async def one(due):
+        async with available:
+            connection = idle.pop() if idle else Connection(*target)
+            await timed_get(connection, recorder, due)
+            idle.append(connection)
+
+    end = start + warmup + duration
+    sent = 0
+    while True:
+        due = start + sent * interval
+        if due >= end:
+            break
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.ensure_future(one(due))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        sent += 1
+
+    if tasks:
+        await asyncio.wait(tasks)
+    for connection in idle:
+        connection.close()
+    return recorder, duration
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(name, params, recorder, elapsed):
+    ordered = sorted(recorder.latencies)
+    ms = lambda seconds: None if seconds is None else round(seconds * 1e3, 3)
+    latency = {f"p{p:g}": ms(percentile(ordered, p)) for p in PERCENTILES}
+    latency["min"] = ms(ordered[0] if ordered else None)
+    latency["max"] = ms(ordered[-1] if ordered else None)
+    latency["mean"] = ms(sum(ordered) / len(ordered) if ordered else None)
+    errors = sum(recorder.errors.values())
+    return {
+        "name": name,
+        **params,
+        "requests": len(ordered),
+        "errors": errors,
+        "error_kinds": dict(sorted(recorder.errors.items())),
+        "throughput_rps": round(len(ordered) / elapsed, 1) if elapsed else 0,
+        "latency_ms": latency,
+    }
+
+
+async def run_suite(args, target):
+    results = []
+    for concurrency in args.closed:
+        recorder, elapsed = await run_closed(target, concurrency,
+                                             args.duration, args.warmup)
+        results.append(summarize(f"closed-c{concurrency}",
+                                 {"mode": "closed", "concurrency": concurrency},
+                                 recorder, elapsed))
+        report_progress(results[-1])
+    for rate in args.open:
+        recorder, elapsed = await run_open(target, rate, args.duration,
+                                           args.warmup, args.max_connections)
+        results.append(summarize(f"open-r{rate:g}",
+                                 {"mode": "open", "rate": rate},
+                                 recorder, elapsed))
+        report_progress(results[-1])
+    return results
+
+
+def report_progress(result):
+    latency = result["latency_ms"]
+    print(f"{result['name']:>14}: {result['throughput_rps']:>9} req/s  "
+          f"p50 {latency['p50']} ms  p99 {latency['p99']} ms  "
+          f"errors {result['errors']}", file=sys.stderr)
+
+
+def parse_list(text, kind):
+    return [kind(item) for item in text.split(",") if item.strip()]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(server_args):
+    """Start server.py on a free port and wait until it accepts"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT, "--port", str(port),
+         *shlex.split(server_args)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f"server.py exited with status {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    sys.exit("server.py did not start listening within 10s")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--url", default=DEFAULT_URL,
+                        help="server to load; ignored with --spawn except "
+                             "for its path")
+    parser.add_argument("--spawn", metavar="SERVER_ARGS",
+                        help="start a local server.py with these arguments "
+                             "on a free port for the run")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION,
+                        help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP,
+                        help="unmeasured seconds before each scenario")
+    parser.add_argument("--closed", default=DEFAULT_CLOSED,
+                        help="comma separated concurrency levels for "
+                             "closed-loop scenarios")
+    parser.add_argument("--open", default=DEFAULT_OPEN,
+                        help="comma separated request rates (req/s) for "
+                             "open-loop scenarios")
+    parser.add_argument("--max-connections", type=int,
+                        default=DEFAULT_MAX_CONNECTIONS,
+                        help="connections an open-loop scenario may open")
+    parser.add_argument("--output", help="write the JSON report here "
+                                         "instead of stdout")
+    args = parser.parse_args(argv)
+    for option, kind in (("closed", int), ("open", float)):
+        try:
+            values = parse_list(getattr(args, option), kind)
+        except ValueError:
+            values = None
+        if values is None or not all(0 < value < float("inf")
+                                     for value in values):
+            parser.error(f"--{option} takes a comma separated list of "
+                         f"positive numbers, not {getattr(args, option)!r}")
+        setattr(args, option, values)
+    if not 0 < args.duration < float("inf"):
+        parser.error("--duration must be a positive number of seconds")
+    if not 0 <= args.warmup < float("inf"):
+        parser.error("--warmup must be 0 or more seconds")
+    if args.max_connections < 1:
+        parser.error("--max-connections must be at least 1")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    url = urlsplit(args.url)
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+
+    server = None
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    if args.spawn is not None:
+        server, port = spawn_server(args.spawn)
+        host = "127.0.0.1"
+
+    request = (f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+               f"User-Agent: bench.py\r\n\r\n").encode()
+    try:
+        results = asyncio.run(run_suite(args, (host, port, request)))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report = {
+        "target": {"path": path,
+                   "spawn": args.spawn,
+                   "url": None if args.spawn is not None else args.url},
+        "settings": {"duration": args.duration, "warmup": args.warmup,
+                     "max_connections": args.max_connections},
+        "environment": {"python": platform.python_version(),
+                        "cpus": os.cpu_count()},
+        "scenarios": results,
+    }
+    text = json.dumps(report, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)